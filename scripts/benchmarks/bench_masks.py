@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from masks import mask_bounds, pack_mask  # noqa: E402
+
+"""
+Micro-benchmark of the bounding box and bit-packing of seg mask planes,
+comparing masks.py with the sum/nonzero/int64 code it replaced.
+"""
+
+
+def legacy_mask(binim):
+    """Bounding box and bytes, as computed by the original mask_from_binary_image"""
+    xmask = binim.sum(0).nonzero()[0]
+    ymask = binim.sum(1).nonzero()[0]
+    if any(xmask) and any(ymask):
+        x0 = min(xmask)
+        w = max(xmask) - x0 + 1
+        y0 = min(ymask)
+        h = max(ymask) - y0 + 1
+        submask = binim[y0:(y0 + h), x0:(x0 + w)]
+    else:
+        return None
+    return x0, y0, w, h, np.packbits(np.asarray(submask, dtype=int))
+
+
+def kernel_mask(binim):
+    bounds = mask_bounds(binim)
+    if len(bounds[0]) == 0:
+        return None
+    _, x0, y0, w, h = (int(values[0]) for values in bounds)
+    return x0, y0, w, h, pack_mask(binim, x0, y0, w, h)
+
+
+def make_planes(size, count, seed=0):
+    """uint8 planes like seg images: a nucleus-sized disc plus sparse foci"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    planes = np.zeros((count, size, size), dtype=np.uint8)
+    for plane in planes:
+        cy, cx = rng.integers(size // 4, 3 * size // 4, 2)
+        radius = rng.integers(size // 8, size // 4)
+        plane[(yy - cy) ** 2 + (xx - cx) ** 2 < radius ** 2] = 1
+        foci = rng.integers(0, size, (50, 2))
+        plane[foci[:, 0], foci[:, 1]] = 1
+    return planes
+
+
+def main(args):
+    planes = make_planes(args.size, args.planes)
+
+    for plane in planes:
+        legacy, kernel = legacy_mask(plane), kernel_mask(plane)
+        assert legacy[:4] == kernel[:4] and np.array_equal(legacy[4], kernel[4])
+
+    def time_per_plane(func):
+        seconds = timeit.timeit(lambda: [func(p) for p in planes], number=args.repeat)
+        return seconds / (args.repeat * len(planes))
+
+    legacy = time_per_plane(legacy_mask)
+    kernel = time_per_plane(kernel_mask)
+    stack = timeit.timeit(lambda: mask_bounds(planes), number=args.repeat)
+    stack /= args.repeat * len(planes)
+    print("%sx%s planes, %s per run, %s runs" % (args.size, args.size, args.planes, args.repeat))
+    print("legacy mask_from_binary_image  %8.2f ms/plane" % (legacy * 1000))
+    print("masks.mask_bounds + pack_mask  %8.2f ms/plane  (%.1fx)" % (kernel * 1000, legacy / kernel))
+    print("masks.mask_bounds of 3D stack  %8.2f ms/plane  (bounds only)" % (stack * 1000))
+
+
+parser = argparse.ArgumentParser(description="Benchmark seg mask bounding box and packing")
+parser.add_argument("--size", type=int, default=2048, help="Width and height of planes")
+parser.add_argument("--planes", type=int, default=8, help="Number of planes")
+parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs")
+
+# Usage:
+# python scripts/benchmarks/bench_masks.py [--size 2048] [--planes 8]
+
+if __name__ == "__main__":
+    main(parser.parse_args())
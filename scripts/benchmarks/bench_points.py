@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import argparse
+import decimal
+from collections import defaultdict
+import os
+import sys
+import time
+
+import numpy as np
+import pandas
+
+import omero
+from omero.rtypes import rdouble, rint, rstring, unwrap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from csv_to_points import (  # noqa: E402
+    DataTable, colors, create_points, get_point_columns, group_by_chr, rgba_to_int)
+from synthetic import embryo_table, fov_table  # noqa: E402
+
+"""
+Checks that the Points of csv_to_points.py, built from NumPy columns, are the
+same as those of the row-by-row iterrows loop they replaced, and times both.
+
+Each table is checked for all its rows (the _hyb image of an embryo) and for
+each cell (the processed images). Without data_table files, synthetic embryo
+and fov tables are used, with Z values that round from exact .5 ties and
+negative Z, where half-up rounding differs from Python's round().
+"""
+
+
+def legacy_points(df, tables_path, cell_id=None):
+    """
+    Returns [(chr_id, [row index], [PointI])] as created by the original
+    process_image, without saving them
+    """
+    rows_by_chr = defaultdict(list)
+    max_chr = 0
+
+    # first, group rows by chr_id (or hg38_chr ?? for experimentA)
+    if cell_id is None:
+        # experimentB only...
+        for index, row in df.iterrows():
+            # chr_id based on cell AND chr for _hybridization images
+            chr_id = (100 * row['cell_id']) + row['chr']       # e.g. 120
+            max_chr = max(max_chr, chr_id)
+            rows_by_chr[chr_id].append((index, row))
+    else:
+        # filter table rows by cell_id
+        if 'embryo' in tables_path:
+            cell_key = 'cell_id'
+            chr_key = 'chr'
+        else:
+            cell_key = 'fov_cell'
+            chr_key = 'hg38_chr'
+        for index, row in df.loc[df[cell_key] == cell_id].iterrows():
+            chr_id = row[chr_key]
+            max_chr = max(max_chr, chr_id)
+            rows_by_chr[chr_id].append((index, row))
+
+    def get_coord(row, xyz="x"):
+        # corrected coords for experiment B _hyb
+        if cell_id is None and 'embryo' in tables_path:
+            return row[xyz + "_um_abs"]
+        # experiment A or processed experiment B images
+        return row[xyz + "_um"]
+
+    rois = []
+    for chr_id in range(max_chr):
+        if chr_id not in rows_by_chr:
+            continue
+        points = []
+        for index, row in rows_by_chr[chr_id]:
+            point = omero.model.PointI()
+            # NB: switch X and Y (analysis used a different coordinate system)
+            point.y = rdouble(get_coord(row, 'x') * 9.2306)
+            point.x = rdouble(get_coord(row, 'y') * 9.2306)
+            # We don't want Python3 behaviour of rounding .5 to even number - always round up
+            point.theZ = rint(int(decimal.Decimal(get_coord(row, 'z') * 2.5).quantize(
+                decimal.Decimal('1'), rounding=decimal.ROUND_HALF_UP)))
+            if 'embryo' in tables_path:
+                # experimentB - get chr number from name
+                chr_name = row['chr_name']
+                if cell_id is None:
+                    point.textValue = rstring(f"cell{row['cell_id']}_{row['chr_name']}")
+                else:
+                    point.textValue = rstring(row['chr_name'])
+            else:
+                # experimentA - no cell ID included in chr_id
+                point.textValue = rstring('hg38_chr' + str(row['hg38_chr']))
+                chr_name = 'chr' + str(row['hg38_chr'])
+            if chr_name in colors:
+                point.strokeColor = rint(rgba_to_int(*colors[chr_name]))
+            points.append(point)
+        rois.append((chr_id, [index for index, row in rows_by_chr[chr_id]], points))
+    return rois
+
+
+def column_points(data_table, cell_id=None):
+    """Returns [(chr_id, [row index], [PointI])] as created by process_image"""
+    rows = data_table.get_rows(cell_id)
+    points = get_point_columns(rows, data_table.tables_path, cell_id)
+    return [(chr_id, list(chr_points.index), create_points(chr_points))
+            for chr_id, chr_points in group_by_chr(points)]
+
+
+def point_values(point):
+    return (unwrap(point.x), unwrap(point.y), unwrap(point.theZ),
+            unwrap(point.textValue), unwrap(point.strokeColor))
+
+
+def roi_values(rois):
+    return [(int(chr_id), [int(index) for index in indexes],
+             [point_values(point) for point in points])
+            for chr_id, indexes, points in rois]
+
+
+def add_ties(df, columns, rng):
+    """Sets about 30% of the Z values to multiples of 0.2 from -1, many of which are .5 ties x 2.5"""
+    df = df.copy()
+    for column in columns:
+        rows = rng.random(len(df)) < 0.3
+        df.loc[rows, column] = rng.integers(-5, 75, rows.sum()) * 0.2
+    return df
+
+
+def synthetic_tables(cells, rows_per_cell, seed=0):
+    """Returns [(tables_path, df)] for a synthetic embryo and fov table"""
+    rng = np.random.default_rng(seed)
+    embryo = add_ties(embryo_table(cells, rows_per_cell, rng), ["z_um", "z_um_abs"], rng)
+    fov = add_ties(fov_table(cells, rows_per_cell, rng), ["z_um"], rng)
+    return [("synthetic_embryo_data_table.csv", embryo), ("synthetic_fov_data_table.csv", fov)]
+
+
+def main(args):
+    if args.tables:
+        tables = [(path, pandas.read_csv(path, delimiter=",")) for path in args.tables]
+    else:
+        tables = synthetic_tables(args.cells, args.rows)
+
+    for tables_path, df in tables:
+        data_table = DataTable(df, tables_path)
+        # the _hyb image of an embryo has the Points of all cells
+        cell_ids = [None] if 'embryo' in tables_path else []
+        cell_ids += sorted(data_table.cells)
+
+        legacy_seconds = column_seconds = 0
+        points = 0
+        for cell_id in cell_ids:
+            start = time.time()
+            legacy = roi_values(legacy_points(df, tables_path, cell_id))
+            legacy_seconds += time.time() - start
+            start = time.time()
+            columns = roi_values(column_points(data_table, cell_id))
+            column_seconds += time.time() - start
+            assert legacy == columns, "Points differ for cell %s of %s" % (cell_id, tables_path)
+            points += sum(len(values) for chr_id, indexes, values in columns)
+
+        print("%s: %s rows, %s images, %s points are the same" % (
+            tables_path, len(df), len(cell_ids), points))
+        print("    legacy iterrows  %8.3f s" % legacy_seconds)
+        print("    point columns    %8.3f s  (%.1fx)" % (column_seconds, legacy_seconds / column_seconds))
+
+
+parser = argparse.ArgumentParser(description="Check and time csv_to_points Points against the iterrows loop")
+parser.add_argument("tables", nargs="*",
+    help="data_table.csv files (embryo or fov in the name), instead of synthetic tables")
+parser.add_argument("--cells", type=int, default=4, help="Cells in each synthetic table")
+parser.add_argument("--rows", type=int, default=500, help="Rows per cell of the synthetic tables")
+
+# Usage:
+# python scripts/benchmarks/bench_points.py [embryo01_data_table.csv fov01_data_table.csv]
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_omero import FakeGateway, FakeServer  # noqa: E402
+from synthetic import layout, make_data  # noqa: E402
+
+"""
+End-to-end benchmarks of the idr0101 scripts against a FakeServer with
+synthetic data, reporting the time, server round trips, rates and peak
+memory of each script.
+
+Each script runs in its own process, so that the peak RSS is its own.
+"""
+
+SCRIPTS = ["csv_to_points", "seg_images_to_masks", "delete_timestamps", "find_images"]
+
+
+def run_script(name, conn, paths, work_dir):
+    """Runs the main() of a script against the fake gateway"""
+    module = __import__(name)
+    # point the scripts at the synthetic files
+    for key, value in paths.items():
+        if hasattr(module, key):
+            setattr(module, key, value)
+
+    if name == "csv_to_points":
+        module.main(conn, work_dir=work_dir)
+    elif name == "seg_images_to_masks":
+        module.main(conn, work_dir=work_dir)
+    elif name == "delete_timestamps":
+        module.main(conn, experimentB=True)
+    elif name == "find_images":
+        project_ids = sorted(conn.server.projects)
+        containers = ["Project:%s" % project_id for project_id in project_ids]
+        module.main(conn, module.parser.parse_args(["_hyb"] + containers))
+
+
+def bench_script(name, args):
+    """Returns the results of running a script once, in this process"""
+    paths, projects = layout(args.data_dir, args.fovs, args.cells)
+    server = FakeServer(args.latency)
+    for project_name, datasets in projects.items():
+        server.add_project(project_name, datasets, plane_infos=args.timepoints)
+    conn = FakeGateway(server)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            run_script(name, conn, paths, work_dir)
+            seconds = time.perf_counter() - start
+
+    counts = server.counts
+    return {
+        "script": name,
+        "seconds": round(seconds, 3),
+        "round_trips": sum(server.calls.values()),
+        "calls": dict(server.calls),
+        "counts": dict(counts),
+        "shapes_per_sec": round(counts["shapes_saved"] / seconds, 1),
+        "table_rows_per_sec": round(counts["table_rows"] / seconds, 1),
+        "query_rows_per_sec": round(counts["rows_returned"] / seconds, 1),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "latency_ms": args.latency * 1000,
+    }
+
+
+def main(args):
+    if args.script:
+        # child process: print the results as the last line
+        print(json.dumps(bench_script(args.script, args)))
+        return
+
+    if not os.path.exists(args.data_dir):
+        print("Making synthetic data in", args.data_dir)
+        make_data(args.data_dir, args.fovs, args.cells, args.rows_per_cell,
+                  args.seg_size, args.seg_planes)
+
+    print("%-22s %9s %8s %11s %11s %11s %9s" % (
+        "script", "seconds", "trips", "shapes/s", "tbl rows/s", "qry rows/s", "peak MB"))
+    for name in args.scripts:
+        command = [sys.executable, os.path.abspath(__file__), "--script", name,
+                   "--data-dir", args.data_dir, "--fovs", str(args.fovs),
+                   "--cells", str(args.cells), "--timepoints", str(args.timepoints),
+                   "--latency", str(args.latency)]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-22s %9.2f %8d %11.0f %11.0f %11.0f %9.1f" % (
+            name, result["seconds"], result["round_trips"], result["shapes_per_sec"],
+            result["table_rows_per_sec"], result["query_rows_per_sec"], result["peak_rss_mb"]))
+        if args.json:
+            with open(args.json, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+
+parser = argparse.ArgumentParser(description="Benchmark the idr0101 scripts with a fake OMERO server")
+parser.add_argument("scripts", nargs="*", default=SCRIPTS, help="Scripts to run (default all)")
+parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "idr0101-bench"),
+    help="Directory of the synthetic data, made if it doesn't exist")
+parser.add_argument("--fovs", type=int, default=2, help="Number of experimentA FOVs")
+parser.add_argument("--cells", type=int, default=4, help="Number of cells per FOV and embryo")
+parser.add_argument("--rows-per-cell", type=int, default=500, help="data_table rows per cell")
+parser.add_argument("--seg-size", type=int, default=512, help="Width and height of seg images")
+parser.add_argument("--seg-planes", type=int, default=16, help="Number of planes of seg images")
+parser.add_argument("--timepoints", type=int, default=10, help="PlaneInfo at Z=0, C=0 per image")
+parser.add_argument("--latency", type=float, default=0.002,
+    help="Simulated seconds per server round trip")
+parser.add_argument("--json", help="Append the results of each script to this JSON lines file")
+parser.add_argument("--script", help=argparse.SUPPRESS)
+
+# Usage:
+# python scripts/benchmarks/bench_scripts.py [csv_to_points ...] [--latency 0.005] [--json results.jsonl]
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+from collections import Counter
+import itertools
+import re
+import time
+
+import omero
+from omero.gateway.utils import ServiceOptsDict
+from omero.rtypes import rlong, rstring, unwrap
+
+"""
+In-memory stand-in for an OMERO server, for benchmarking the idr0101 scripts
+without a production server.
+
+FakeGateway has the parts of BlitzGateway that the scripts use. Every call
+that would be a server round trip is counted by name in FakeServer.calls and
+sleeps for the simulated latency. Objects are real omero.model objects, so
+omero-py is needed, but not a server.
+
+QueryService only answers the HQL queries that the scripts make, and raises
+NotImplementedError for any other query, so that a changed query shows up.
+"""
+
+
+class FakeServer(object):
+    """The objects on the fake server, and counts of calls and objects"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.counts = Counter()
+        self.ids = itertools.count(1)
+        self.projects = {}      # id: (name, group_id)
+        self.datasets = {}      # id: (name, [project_ids])
+        self.images = {}        # id: (name, [dataset_ids])
+        self.rois = {}          # id: (image_id, set of shape types)
+        self.plane_infos = {}   # id: (pixels_id, theZ, theC)
+
+    def call(self, name):
+        """Records a round trip to the server"""
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_id(self):
+        return next(self.ids)
+
+    def add_project(self, name, datasets, group_id=3, plane_infos=1):
+        """
+        Adds a Project with datasets, a dict of {dataset_name: [image_names]}.
+        Each image has plane_infos PlaneInfo at Z=0, C=0 (one per T).
+        Returns the Project ID.
+        """
+        project_id = self.new_id()
+        self.projects[project_id] = (name, group_id)
+        for dataset_name, image_names in datasets.items():
+            dataset_id = self.new_id()
+            self.datasets[dataset_id] = (dataset_name, [project_id])
+            for image_name in image_names:
+                image_id = self.new_id()
+                self.images[image_id] = (image_name, [dataset_id])
+                # Pixels ID is the same as the Image ID
+                for t in range(plane_infos):
+                    self.plane_infos[self.new_id()] = (image_id, 0, 0)
+        return project_id
+
+    def group_of_image(self, image_id):
+        dataset_id = self.images[image_id][1][0]
+        project_id = self.datasets[dataset_id][1][0]
+        return self.projects[project_id][1]
+
+
+def like_to_regex(pattern):
+    """Converts an HQL 'like' pattern to a compiled regex"""
+    parts = (".*" if char == "%" else "." if char == "_" else re.escape(char)
+             for char in pattern)
+    return re.compile("^" + "".join(parts) + "$", re.DOTALL)
+
+
+def get_ids(params, name="ids"):
+    return unwrap(params.map[name])
+
+
+def get_page(params, rows):
+    """Applies the offset and limit of params.page() to the rows"""
+    page = params.theFilter
+    if page is None or page.limit is None:
+        return rows
+    offset = unwrap(page.offset) or 0
+    return rows[offset:offset + unwrap(page.limit)]
+
+
+def wrap_row(row):
+    return [None if value is None else
+            rstring(value) if isinstance(value, str) else rlong(value)
+            for value in row]
+
+
+class FakeQueryService(object):
+    """Answers the projection queries made by the idr0101 scripts"""
+
+    def __init__(self, server):
+        self.server = server
+        self.handlers = [
+            ("from ProjectDatasetLink pdl join pdl.parent p", self.container_index),
+            ("select d.id, d.name, i.id, i.name from Dataset d", self.dataset_index),
+            ("select i.id, i.name, d.id, d.name from", self.find_images),
+            ("select r.id from Roi r where r.image.id in", self.rois_by_image),
+            ("select distinct s.roi.id from", self.rois_by_shape),
+            ("select r.id from Roi r where r.id in", self.existing_rois),
+            ("select p.id from Pixels p where p.image.id in", self.pixels),
+            ("select Info.id from PlaneInfo as Info", self.plane_infos),
+        ]
+
+    def projection(self, query, params, ctx=None):
+        self.server.call("projection")
+        for start, handler in self.handlers:
+            if start in query:
+                rows = [wrap_row(row) for row in handler(query, params)]
+                self.server.counts["rows_returned"] += len(rows)
+                return rows
+        raise NotImplementedError(query)
+
+    def _dataset_rows(self, dataset_id):
+        server = self.server
+        dataset_name = server.datasets[dataset_id][0]
+        images = sorted((name, image_id) for image_id, (name, dataset_ids)
+                        in server.images.items() if dataset_id in dataset_ids)
+        return dataset_name, [(image_id, name) for name, image_id in images]
+
+    def container_index(self, query, params):
+        server = self.server
+        if "p.name in (:names)" in query:
+            names = get_ids(params, "names")
+            project_ids = [pid for pid, (name, group_id) in server.projects.items()
+                           if name in names]
+        else:
+            project_ids = get_ids(params)
+        rows = []
+        for pid in sorted(project_ids):
+            pname, group_id = server.projects[pid]
+            datasets = sorted((name, did) for did, (name, pids) in server.datasets.items()
+                              if pid in pids)
+            for dname, did in datasets:
+                images = self._dataset_rows(did)[1] or [(None, None)]
+                for iid, iname in images:
+                    rows.append((pid, pname, group_id, did, dname, iid, iname))
+        return rows
+
+    def dataset_index(self, query, params):
+        rows = []
+        for did in get_ids(params):
+            dname, images = self._dataset_rows(did)
+            rows.extend((did, dname, iid, iname) for iid, iname in images)
+        return rows
+
+    def find_images(self, query, params):
+        server = self.server
+        ids = get_ids(params)
+        if "pdl.parent.id in (:ids)" in query:
+            dataset_ids = [did for did, (name, pids) in server.datasets.items()
+                           if set(pids) & set(ids)]
+        else:
+            dataset_ids = ids
+        rows = []
+        for did in dataset_ids:
+            dname, images = self._dataset_rows(did)
+            rows.extend((iid, iname, did, dname) for iid, iname in images)
+        if "like :pattern" in query:
+            regex = like_to_regex(unwrap(params.map["pattern"]))
+            lower = "lower(i.name)" in query
+            rows = [row for row in rows
+                    if regex.match(row[1].lower() if lower else row[1])]
+        rows.sort(key=lambda row: (row[0], row[2]))
+        return get_page(params, rows)
+
+    def rois_by_image(self, query, params):
+        image_ids = set(get_ids(params))
+        return [(roi_id,) for roi_id, (image_id, types) in self.server.rois.items()
+                if image_id in image_ids]
+
+    def rois_by_shape(self, query, params):
+        shape_type = re.search(r"from (\w+) s", query).group(1)
+        image_ids = set(get_ids(params))
+        return [(roi_id,) for roi_id, (image_id, types) in self.server.rois.items()
+                if image_id in image_ids and shape_type in types]
+
+    def existing_rois(self, query, params):
+        return [(roi_id,) for roi_id in get_ids(params) if roi_id in self.server.rois]
+
+    def pixels(self, query, params):
+        return [(image_id,) for image_id in get_ids(params)
+                if image_id in self.server.images]
+
+    def plane_infos(self, query, params):
+        z, c = (int(value) for value in re.search(
+            r"theZ=(\d+) and Info.theC=(\d+)", query).groups())
+        pixels_ids = set(get_ids(params))
+        return [(info_id,) for info_id, (pixels_id, the_z, the_c)
+                in self.server.plane_infos.items()
+                if pixels_id in pixels_ids and (the_z, the_c) == (z, c)]
+
+
+class FakeUpdateService(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def saveAndReturnArray(self, objects):
+        self.server.call("saveAndReturnArray")
+        for obj in objects:
+            self._save(obj)
+        return objects
+
+    def saveObject(self, obj, ctx=None):
+        self.server.call("saveObject")
+        self.server.counts["links_saved"] += 1
+
+    def _save(self, roi):
+        server = self.server
+        roi.setId(rlong(server.new_id()))
+        types = set()
+        for shape in roi.copyShapes():
+            shape.setId(rlong(server.new_id()))
+            types.add(type(shape).__name__[:-1])
+            server.counts["shapes_saved"] += 1
+        server.rois[roi.id.val] = (roi.getImage().id.val, types)
+        server.counts["rois_saved"] += 1
+
+
+class FakeTable(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.file_id = server.new_id()
+
+    def initialize(self, columns):
+        self.server.call("table.initialize")
+
+    def addData(self, columns):
+        self.server.call("table.addData")
+        self.server.counts["table_rows"] += len(columns[0].values) if columns else 0
+
+    def getOriginalFile(self):
+        self.server.call("table.getOriginalFile")
+        return omero.model.OriginalFileI(self.file_id, False)
+
+    def close(self):
+        self.server.call("table.close")
+
+
+class FakeSharedResources(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def newTable(self, repo_id, name, ctx=None):
+        self.server.call("newTable")
+        self.server.counts["tables"] += 1
+        return FakeTable(self.server)
+
+
+class FakeSession(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def sharedResources(self):
+        self.server.call("sharedResources")
+        return FakeSharedResources(self.server)
+
+
+class FakeCallback(object):
+
+    def close(self, close_handle):
+        pass
+
+
+class FakeClient(object):
+    """The omero.client of the gateway (conn.c)"""
+
+    def __init__(self, server):
+        self.server = server
+        self.sf = FakeSession(server)
+
+    def waitOnCmd(self, handle, loops=10, ms=500, failonerror=True,
+                  failontimeout=False, closehandle=False):
+        # the fake Delete2 is done when submitted, so 1 poll
+        self.server.call("waitOnCmd")
+        return FakeCallback()
+
+
+class FakeDetails(object):
+
+    def __init__(self, group_id):
+        self.group = omero.model.ExperimenterGroupI(group_id, False)
+
+
+class FakeImageWrapper(object):
+    """The attributes of an ImageWrapper that the scripts use"""
+
+    def __init__(self, conn, image_id):
+        self._conn = conn
+        self._obj = omero.model.ImageI(image_id, False)
+        self.id = image_id
+        self.name = conn.server.images[image_id][0]
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getDetails(self):
+        return FakeDetails(self._conn.server.group_of_image(self.id))
+
+
+class FakeGateway(object):
+    """Stand-in for BlitzGateway, backed by a FakeServer"""
+
+    def __init__(self, server):
+        self.server = server
+        self.c = FakeClient(server)
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.query_service = FakeQueryService(server)
+        self.update_service = FakeUpdateService(server)
+
+    def getQueryService(self):
+        return self.query_service
+
+    def getUpdateService(self):
+        return self.update_service
+
+    def getObject(self, obj_type, oid=None, attributes=None):
+        self.server.call("getObject")
+        if obj_type != "Image":
+            raise NotImplementedError("getObject %s" % obj_type)
+        if oid not in self.server.images:
+            return None
+        return FakeImageWrapper(self, oid)
+
+    def deleteObjects(self, obj_type, obj_ids, deleteAnns=False,
+                      deleteChildren=False, wait=False):
+        self.server.call("Delete2")
+        store = {"Roi": self.server.rois, "PlaneInfo": self.server.plane_infos}[obj_type]
+        for obj_id in obj_ids:
+            if store.pop(obj_id, None) is not None:
+                self.server.counts["objects_deleted"] += 1
+        return "handle"
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import os
+
+import numpy as np
+import pandas
+from PIL import Image
+
+"""
+Synthetic idr0101 inputs for the benchmarks: data_tables, bounds files and
+seg TIFFs laid out like the files on /uod/idr/filesets, plus the Projects,
+Datasets and Images to add to a FakeServer.
+"""
+
+# experimentB always has 57 embryos (csv_to_points looks for each of them)
+EMBRYOS = 57
+SEGS_A = ["nucleus"]
+SEGS_B = ["nucleus", "npbs", "lamin", "cenpa"]
+CHR_NAMES = ["chr%s" % c for c in list(range(1, 23)) + ["X"]]
+
+
+def embryo_table(cells, rows_per_cell, rng):
+    """Rows of an embryo data_table, for cells 1 to cells"""
+    n = cells * rows_per_cell
+    chr_ = rng.integers(1, len(CHR_NAMES) + 1, n)
+    return pandas.DataFrame({
+        "cell_id": np.repeat(np.arange(1, cells + 1), rows_per_cell),
+        "chr": chr_,
+        "chr_name": np.array(CHR_NAMES)[chr_ - 1],
+        "x_um": rng.uniform(0, 40, n),
+        "y_um": rng.uniform(0, 40, n),
+        "z_um": rng.uniform(0, 15, n),
+        "x_um_abs": rng.uniform(0, 200, n),
+        "y_um_abs": rng.uniform(0, 200, n),
+        "z_um_abs": rng.uniform(0, 15, n),
+        "hg38_pos": rng.integers(0, 250000000, n),
+        "cluster": rng.choice(["A", "B", "none"], n),
+    })
+
+
+def fov_table(cells, rows_per_cell, rng):
+    """Rows of a fibroblast FOV data_table, for cells 1 to cells"""
+    n = cells * rows_per_cell
+    return pandas.DataFrame({
+        "fov_cell": np.repeat(np.arange(1, cells + 1), rows_per_cell),
+        "hg38_chr": rng.integers(1, 24, n),
+        "x_um": rng.uniform(0, 40, n),
+        "y_um": rng.uniform(0, 40, n),
+        "z_um": rng.uniform(0, 15, n),
+        "hg38_pos": rng.integers(0, 250000000, n),
+        "cluster": rng.choice(["A", "B", "none"], n),
+    })
+
+
+def write_bounds(path, cells, with_z, rng):
+    """A line of x, y, (z), width, height, (depth) for each cell"""
+    with open(path, "w") as f:
+        for cell in range(cells):
+            x, y = rng.integers(0, 1500, 2)
+            if with_z:
+                f.write("%s,%s,%s,%s,%s,%s\n" % (x, y, rng.integers(0, 5), 200, 200, 10))
+            else:
+                f.write("%s,%s,%s,%s\n" % (x, y, 200, 200))
+
+
+def write_seg_tiff(path, size, planes, rng):
+    """A binary uint8 stack with a disc per plane and some sparse blobs"""
+    yy, xx = np.mgrid[:size, :size]
+    images = []
+    for z in range(planes):
+        plane = np.zeros((size, size), dtype=np.uint8)
+        cy, cx = rng.integers(size // 4, 3 * size // 4, 2)
+        radius = rng.integers(size // 8, size // 4)
+        plane[(yy - cy) ** 2 + (xx - cx) ** 2 < radius ** 2] = 1
+        for by, bx in rng.integers(0, size - 8, (20, 2)):
+            plane[by:by + 6, bx:bx + 6] = 1
+        images.append(Image.fromarray(plane))
+    images[0].save(path, save_all=True, append_images=images[1:])
+
+
+def layout(root, fovs=2, cells=4):
+    """
+    Returns (paths, projects) for synthetic data under root: paths is a dict
+    of the path templates to set on the scripts, and projects is
+    {project: {dataset: [image names]}} for the FakeServer.
+    """
+    paths = {
+        "tables_path_A": os.path.join(root, "tables", "fov%02d_data_table.csv"),
+        "bounds_path_A": os.path.join(root, "bounds", "fov%02d_cell_bounds.txt"),
+        "tables_path_B": os.path.join(root, "tables", "embryo%02d_data_table.csv"),
+        "bounds_path_B": os.path.join(root, "bounds", "embryo%02d_bounds.txt"),
+        "seg_images_path_A": os.path.join(root, "seg", "pgp1", "fov0%s", "%s") + os.sep,
+        "seg_images_path_B": os.path.join(root, "seg", "embryo", "embryo%s", "%s") + os.sep,
+        "seg_images_path_B2": os.path.join(root, "seg", "late", "embryo%s_%s_"),
+    }
+    processed = ["cell%03d_processed" % cell for cell in range(1, cells + 1)]
+    datasets_A = {}
+    for fov in range(1, fovs + 1):
+        datasets_A["Fibroblasts_%02d" % fov] = (
+            ["pgp1_fov%02d_seq" % fov, "pgp1_fov%02d_hyb" % fov] + processed)
+    datasets_B = {}
+    for embryo in range(1, EMBRYOS + 1):
+        datasets_B["Embryo_%02d" % embryo] = ["embryo%02d_hyb" % embryo] + processed
+    projects = {
+        "idr0101-payne-insitugenomeseq/experimentA": datasets_A,
+        "idr0101-payne-insitugenomeseq/experimentB": datasets_B,
+    }
+    return paths, projects
+
+
+def make_data(root, fovs=2, cells=4, rows_per_cell=500, seg_size=512,
+              seg_planes=16, seed=0):
+    """
+    Writes the synthetic files under root, for the layout() with the same
+    fovs and cells.
+
+    Each cell of every FOV and embryo has seg images, linked to one TIFF
+    per seg type so that they don't all use disk space.
+    """
+    rng = np.random.default_rng(seed)
+    paths, projects = layout(root, fovs, cells)
+    for name in ["tables", "bounds", "segfiles"]:
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    seg_files = {}
+    for seg in SEGS_B:
+        seg_files[seg] = os.path.join(root, "segfiles", "seg_%s.tif" % seg)
+        write_seg_tiff(seg_files[seg], seg_size, seg_planes, rng)
+
+    def link_segs(seg_dir, segs):
+        os.makedirs(seg_dir, exist_ok=True)
+        for seg in segs:
+            link = os.path.join(seg_dir, "seg_%s.tif" % seg)
+            if not os.path.exists(link):
+                os.symlink(seg_files[seg], link)
+
+    cell_names = ["cell%03d" % cell for cell in range(1, cells + 1)]
+    for fov in range(1, fovs + 1):
+        fov_table(cells, rows_per_cell, rng).to_csv(paths["tables_path_A"] % fov, index=False)
+        write_bounds(paths["bounds_path_A"] % fov, cells, False, rng)
+        for cell_name in cell_names:
+            link_segs(paths["seg_images_path_A"] % ("%02d" % fov, cell_name), SEGS_A)
+
+    for embryo in range(1, EMBRYOS + 1):
+        embryo_table(cells, rows_per_cell, rng).to_csv(paths["tables_path_B"] % embryo, index=False)
+        write_bounds(paths["bounds_path_B"] % embryo, cells, True, rng)
+        for cell_name in cell_names:
+            link_segs(paths["seg_images_path_B"] % ("%02d" % embryo, cell_name), SEGS_B)
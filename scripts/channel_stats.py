@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from PIL import Image
+import yaml
+
+import omero
+import omero.cli
+from omero.rtypes import rdouble
+
+from checkpoint import DEFAULT_WORK_DIR
+from container_index import load_index
+from file_paths import expand_pattern, parse_target, read_file_paths
+from omero_bulk import QUERY_CHUNK_SIZE, chunks, save_objects
+from tiff_planes import iter_planes
+
+"""
+Computes the min, max and percentiles of each channel of the images in
+filePaths.tsv files, from the TIFF files on disk, since the images are
+imported with 'skip: minmax'.
+
+Processed images are .pattern files of single channel Z-stacks
+(cellNNN_tNN_cNN.tif) and the others are OME-TIFFs, which are read plane by
+plane, memory-mapped if not compressed. Stats of each TIFF are cached in
+the work dir, so that only new or changed files are read on a rerun.
+
+The stats are written as a rendering settings YAML for each image (for
+'omero render set'), with the window of each channel at the percentiles,
+and/or saved as the StatsInfo of the channels in OMERO.
+"""
+
+# Pixel types with a histogram of every value (others only have min and max)
+HISTOGRAM_DTYPES = ["uint8", "uint16"]
+
+def ome_page_channels(path):
+    """
+    Returns the channel of each page of an OME-TIFF, from the DimensionOrder
+    and sizes of the first Image in its OME-XML, or None if not an OME-TIFF.
+
+    Pages are assumed to be in the DimensionOrder (no TiffData mapping).
+    """
+    with Image.open(path) as im:
+        description = im.tag_v2.get(270)
+    if not description or "<OME" not in description:
+        return None
+    root = ET.fromstring(description.encode("utf-8"))
+    pixels = next(element for element in root.iter() if element.tag.endswith("}Pixels"))
+    sizes = {dim: int(pixels.get("Size" + dim)) for dim in "ZCT"}
+    order = pixels.get("DimensionOrder")[2:]
+    # the first dimension of the order changes fastest
+    strides = {}
+    stride = 1
+    for dim in order:
+        strides[dim] = stride
+        stride *= sizes[dim]
+    return [(page // strides["C"]) % sizes["C"] for page in range(stride)]
+
+
+def file_stats(path):
+    """
+    Returns {channel: (min, max, histogram)} of the planes of a TIFF, where
+    histogram counts each value up to the max (None for types not in
+    HISTOGRAM_DTYPES).
+    Channels are from the OME-XML of an OME-TIFF, or 0 for other TIFFs.
+    """
+    page_channels = ome_page_channels(path)
+    stats = {}
+    for page, plane in enumerate(iter_planes(path)):
+        if page_channels is not None:
+            if page >= len(page_channels):
+                break
+            channel = page_channels[page]
+        else:
+            channel = 0
+        histogram = None
+        if plane.dtype.name in HISTOGRAM_DTYPES:
+            # as long as the max + 1, not the 65536 values of uint16
+            histogram = np.bincount(plane.ravel())
+            low, high = np.flatnonzero(histogram)[0], len(histogram) - 1
+        else:
+            low, high = plane.min(), plane.max()
+        stats[channel] = merge_stats(stats.get(channel), (float(low), float(high), histogram))
+    return stats
+
+
+def merge_stats(stats, other):
+    """Returns the (min, max, histogram) of both, either of which can be None"""
+    if stats is None:
+        return other
+    if other is None:
+        return stats
+    histogram = None
+    if stats[2] is not None and other[2] is not None:
+        histogram = add_histograms(stats[2], other[2])
+    return min(stats[0], other[0]), max(stats[1], other[1]), histogram
+
+
+def add_histograms(histogram, other):
+    """Returns the sum of two histograms, which can have different lengths"""
+    if len(histogram) < len(other):
+        histogram, other = other, histogram
+    histogram = histogram.copy()
+    histogram[:len(other)] += other
+    return histogram
+
+
+def percentile(histogram, fraction):
+    """Returns the value below which the fraction of the histogram's counts are"""
+    cumulative = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative, fraction * cumulative[-1]))
+
+
+class StatsCache(object):
+    """file_stats() saved in cache_dir, keyed by the real path, size and mtime"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "%s-%s-%s.npz" % (
+            name, stat.st_size, stat.st_mtime_ns))
+
+    def read(self, path):
+        """Returns the cached file_stats() of the file, or None"""
+        cache_path = self.cache_path(path)
+        if not os.path.exists(cache_path):
+            return None
+        stats = {}
+        with np.load(cache_path) as data:
+            for channel, low, high in zip(data["channels"], data["mins"], data["maxs"]):
+                histogram = data.get("hist%s" % channel)
+                if histogram is not None:
+                    # files cached before histograms were trimmed have all 65536 values
+                    histogram = histogram[:int(high) + 1]
+                stats[int(channel)] = (low.item(), high.item(), histogram)
+        return stats
+
+    def write(self, path, stats):
+        cache_path = self.cache_path(path)
+        channels = sorted(stats)
+        arrays = {"channels": np.array(channels),
+                  "mins": np.array([stats[c][0] for c in channels], dtype=float),
+                  "maxs": np.array([stats[c][1] for c in channels], dtype=float)}
+        for channel in channels:
+            if stats[channel][2] is not None:
+                arrays["hist%s" % channel] = stats[channel][2]
+        # written to a temp file, so a failed write can't leave a partial cache file
+        tmp_path = "%s.%s.tmp.npz" % (cache_path, os.getpid())
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, cache_path)
+
+
+def cached_file_stats(path, cache_dir):
+    """file_stats() via the StatsCache, to run in a worker process"""
+    cache = StatsCache(cache_dir)
+    stats = cache.read(path)
+    if stats is None:
+        stats = file_stats(path)
+        cache.write(path, stats)
+    return stats
+
+
+def get_image_files(path):
+    """
+    Returns (channel, file, file channel) for the files of an image: each
+    file of a .pattern is a single channel, an OME-TIFF has all channels.
+    Raises ValueError for other files.
+    """
+    if path.endswith(".pattern"):
+        return [(channel, file_path, 0) for channel, file_path in expand_pattern(path)]
+    if path.endswith((".ome.tiff", ".ome.tif")):
+        page_channels = ome_page_channels(path)
+        if page_channels is None:
+            raise ValueError("no OME-XML")
+        return [(channel, path, channel) for channel in sorted(set(page_channels))]
+    raise ValueError("not a .pattern or OME-TIFF")
+
+
+def get_channel_stats(images, cache_dir, workers=1):
+    """
+    Returns {(target, name): {channel: (min, max, histogram)}} for the
+    (target, path, name) of each image, with the stats of each file
+    computed once, by a pool of worker processes.
+
+    The stats of each file are merged into its images' channels as they
+    arrive, so only the histograms of the channels are kept.
+    """
+    # the (image, channel, file channel) of each file, by real path, since
+    # stain files are linked to every timepoint and are read once
+    file_channels = {}
+    channel_stats = {}
+    for target, path, name in images:
+        try:
+            files = get_image_files(path)
+        except (OSError, ValueError) as exc:
+            print("Skipping %s: %s" % (path, exc))
+            continue
+        channel_stats[(target, name)] = {}
+        for channel, file_path, file_channel in files:
+            file_channels.setdefault(os.path.realpath(file_path), []).append(
+                ((target, name), channel, file_channel))
+
+    def add_file_stats(path, stats):
+        for key, channel, file_channel in file_channels[path]:
+            channels = channel_stats[key]
+            channels[channel] = merge_stats(channels.get(channel), stats.get(file_channel))
+
+    paths = sorted(file_channels)
+    print("Reading stats of %s files" % len(paths))
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(cached_file_stats, path, cache_dir): path for path in paths}
+            for future in as_completed(futures):
+                # popped, so that the stats are freed once merged
+                add_file_stats(futures.pop(future), future.result())
+    else:
+        for path in paths:
+            add_file_stats(path, cached_file_stats(path, cache_dir))
+    return channel_stats
+
+
+def get_windows(channels, low=0.5, high=99.5):
+    """
+    Returns {channel: (start, end)} at the low and high percentiles of each
+    channel, or at its min and max if there's no histogram
+    """
+    windows = {}
+    for channel, (cmin, cmax, histogram) in channels.items():
+        if histogram is None:
+            windows[channel] = (float(cmin), float(cmax))
+        else:
+            windows[channel] = (float(percentile(histogram, low / 100)),
+                                float(percentile(histogram, high / 100)))
+    return windows
+
+
+def render_settings(template, windows):
+    """Returns the template rendering settings with the start and end of each channel"""
+    settings = dict(template)
+    settings["channels"] = {key: dict(value) for key, value in template.get("channels", {}).items()}
+    for channel, (start, end) in windows.items():
+        # channels are numbered from 1 in the YAML
+        settings["channels"].setdefault(channel + 1, {}).update({"start": start, "end": end})
+    return settings
+
+
+def write_settings(channel_stats, template, out_dir, low, high):
+    """Writes out_dir/<dataset>/<image>.yml for each image"""
+    for (target, name), channels in channel_stats.items():
+        project_name, dataset_name = parse_target(target)
+        path = os.path.join(out_dir, dataset_name, "%s.yml" % name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            yaml.safe_dump(render_settings(template, get_windows(channels, low, high)), f,
+                           default_flow_style=False, sort_keys=False)
+    print("Wrote %s rendering settings to %s" % (len(channel_stats), out_dir))
+
+
+def get_image_ids(conn, keys):
+    """Returns {(target, name): image ID} for Project:name:../Dataset:name:.. targets"""
+    project_names = sorted(set(parse_target(target)[0] for target, name in keys))
+    index = load_index(conn, project_names)
+    image_ids = {}
+    for target, name in keys:
+        project_name, dataset_name = parse_target(target)
+        dataset = index.get_dataset(index.get_project(project_name), dataset_name)
+        images = [image for image in index.list_images(dataset) if image.name == name]
+        if len(images) != 1:
+            print("Found %s images %s in %s" % (len(images), name, target))
+            continue
+        image_ids[(target, name)] = images[0].id
+    return image_ids
+
+
+def save_stats_info(conn, channel_stats):
+    """Saves the min and max of each channel as its StatsInfo, in bulk"""
+    image_ids = get_image_ids(conn, channel_stats)
+    stats_by_id = {image_ids[key]: channels for key, channels in channel_stats.items()
+                   if key in image_ids}
+    channels = []
+    for chunk in chunks(stats_by_id, QUERY_CHUNK_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(chunk)
+        # distinct, since the Pixels would be returned once per fetched Channel
+        pixels = conn.getQueryService().findAllByQuery(
+            "select distinct p from Pixels p join fetch p.channels c"
+            " left outer join fetch c.statsInfo where p.image.id in (:ids)",
+            params, conn.SERVICE_OPTS)
+        for pix in pixels:
+            stats = stats_by_id[pix.image.id.val]
+            for index, channel in enumerate(pix.copyChannels()):
+                if index not in stats:
+                    continue
+                stats_info = channel.statsInfo or omero.model.StatsInfoI()
+                stats_info.globalMin = rdouble(stats[index][0])
+                stats_info.globalMax = rdouble(stats[index][1])
+                channel.statsInfo = stats_info
+                channels.append(channel)
+    save_objects(conn, channels)
+    print("Saved StatsInfo of %s channels of %s images" % (len(channels), len(stats_by_id)))
+
+
+def main(conn, args):
+    images = [image for tsv_path in args.file_paths for image in read_file_paths(tsv_path)]
+    cache_dir = os.path.join(args.work_dir, "channel_stats")
+    channel_stats = get_channel_stats(images, cache_dir, args.workers)
+
+    if args.out_dir:
+        template = {"version": 2}
+        if args.template:
+            with open(args.template) as f:
+                template = yaml.safe_load(f)
+        write_settings(channel_stats, template, args.out_dir, args.low, args.high)
+    if conn is not None:
+        save_stats_info(conn, channel_stats)
+
+
+# Usage:
+# cd idr0101-payne-insitugenomeseq
+# python scripts/channel_stats.py experimentA/idr0101-processed-filePaths.tsv --workers 8 \
+#     --template experimentB/rendering_settings/idr0101-experimentB_processed.yml --out-dir /tmp/rendering
+# python scripts/channel_stats.py experimentB/idr0101-experimentB-filePaths.tsv --upload
+
+parser = argparse.ArgumentParser(description="Channel min/max and percentiles of idr0101 images from their files")
+parser.add_argument("file_paths", nargs="+", help="filePaths.tsv files of the images")
+parser.add_argument("--workers", type=int, default=1,
+    help="Number of processes reading files in parallel")
+parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+    help="Directory for the cached stats of each file")
+parser.add_argument("--out-dir", help="Write rendering settings YAML for each image in this directory")
+parser.add_argument("--template", help="Rendering settings YAML with the labels and colors of the channels")
+parser.add_argument("--low", type=float, default=0.5, help="Percentile of the start of each channel window")
+parser.add_argument("--high", type=float, default=99.5, help="Percentile of the end of each channel window")
+parser.add_argument("--upload", action="store_true", default=False,
+    help="Save the min and max of each channel as its StatsInfo in OMERO")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.upload:
+        with omero.cli.cli_login() as c:
+            conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
+            main(conn, args)
+            conn.close()
+    else:
+        main(None, args)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import omero
+
+from omero_bulk import QUERY_CHUNK_SIZE, chunks
+
+"""
+Local checkpoints for the idr0101 ROI imports.
+
+For each image, we store a key made from the content of its input files
+(data_table csv, bounds txt, seg tifs) and the IDs of the ROIs saved from
+them. A rerun can then skip an image if its inputs are unchanged and all
+its ROIs are still on the server, and only redo the images that are stale.
+"""
+
+DEFAULT_WORK_DIR = os.path.join(os.path.expanduser("~"), ".cache", "idr0101")
+
+
+class CheckpointStore(object):
+    """
+    SQLite store of input keys and saved ROI IDs, per script and image
+
+    :param files: Optional FileIndex of the input files, whose size and
+                  mtime are used instead of calling os.stat for each file
+    """
+
+    def __init__(self, work_dir, script, files=None):
+        os.makedirs(work_dir, exist_ok=True)
+        self.script = script
+        self.files = files
+        self.db = sqlite3.connect(os.path.join(work_dir, "checkpoints.sqlite"))
+        self.db.execute(
+            "create table if not exists files"
+            " (path text primary key, size integer, mtime integer, digest text)")
+        self.db.execute(
+            "create table if not exists images"
+            " (script text, image_id integer, inputs text, roi_ids text,"
+            " updated real, primary key (script, image_id))")
+        self.db.commit()
+
+    def file_digest(self, path):
+        """
+        Returns the sha1 of the file content, or None if it doesn't exist.
+
+        Digests are cached by size and mtime, so unchanged files on the NFS
+        mount are only read the first time.
+        """
+        if self.files is not None:
+            stat = self.files.stat(path)
+        else:
+            try:
+                stat = os.stat(path)
+                stat = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                stat = None
+        if stat is None:
+            return None
+        size, mtime = stat
+        row = self.db.execute(
+            "select digest from files where path=? and size=? and mtime=?",
+            (path, size, mtime)).fetchone()
+        if row is not None:
+            return row[0]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+        self.db.execute(
+            "insert or replace into files values (?, ?, ?, ?)",
+            (path, size, mtime, digest))
+        self.db.commit()
+        return digest
+
+    def inputs_key(self, paths, params=None):
+        """Returns a key for the content of the input files and any params"""
+        inputs = [[path, self.file_digest(path)] for path in paths]
+        text = json.dumps([inputs, params], sort_keys=True, default=str)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def current_images(self, conn, keys):
+        """
+        Returns the IDs of the images that were done with the same inputs key
+        and all of whose ROIs saved then are still on the server.
+
+        The ROIs of all the images are checked together, with 1 query per
+        chunk of ROI IDs.
+
+        :param keys: Dict of {image ID: inputs key}
+        """
+        recorded = {}
+        for image_id, inputs, roi_ids in self.db.execute(
+                "select image_id, inputs, roi_ids from images where script=?",
+                (self.script,)):
+            if keys.get(image_id) == inputs:
+                recorded[image_id] = json.loads(roi_ids)
+        existing = find_existing_rois(
+            conn, [roi_id for roi_ids in recorded.values() for roi_id in roi_ids])
+        return set(image_id for image_id, roi_ids in recorded.items()
+                   if existing.issuperset(roi_ids))
+
+    def mark_done(self, image_id, key, roi_ids):
+        self.db.execute(
+            "insert or replace into images values (?, ?, ?, ?, ?)",
+            (self.script, image_id, key, json.dumps(list(roi_ids)), time.time()))
+        self.db.commit()
+
+
+def find_existing_rois(conn, roi_ids):
+    """Returns the set of the ROI IDs that exist on the server"""
+    existing = set()
+    for chunk in chunks(set(roi_ids), QUERY_CHUNK_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(chunk)
+        result = conn.getQueryService().projection(
+            "select r.id from Roi r where r.id in (:ids)",
+            params, conn.SERVICE_OPTS)
+        existing.update(row[0].val for row in result)
+    return existing
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+from collections import namedtuple
+import json
+import os
+import time
+
+import omero
+
+"""
+Index of Project -> Dataset -> Image (id, name) loaded with a single query,
+so that the scripts can look up datasets and images in memory instead of
+listing the children of each container from the server.
+"""
+
+Container = namedtuple("Container", ["id", "name"])
+IndexedImage = namedtuple("IndexedImage", ["id", "name", "dataset_id", "dataset_name"])
+
+QUERY = (
+    "select p.id, p.name, p.details.group.id, d.id, d.name, i.id, i.name"
+    " from ProjectDatasetLink pdl join pdl.parent p join pdl.child d"
+    " left outer join d.imageLinks dil left outer join dil.child i"
+    " where %s order by p.id, d.name, i.name")
+
+# Datasets by ID, including Datasets that aren't in a Project
+DATASET_QUERY = (
+    "select d.id, d.name, i.id, i.name from Dataset d"
+    " left outer join d.imageLinks dil left outer join dil.child i"
+    " where d.id in (:ids) order by d.name, i.name")
+
+
+class ContainerIndex(object):
+    """
+    Projects, Datasets and Images from rows of
+    (project_id, project_name, group_id, dataset_id, dataset_name, image_id, image_name)
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.projects = {}
+        self.groups = {}
+        self.datasets = {}
+        self.images = {}
+        seen = set()
+        for pid, pname, group_id, did, dname, iid, iname in rows:
+            if pid is not None:
+                self.projects[pname] = Container(pid, pname)
+                self.groups[pid] = group_id
+            self.datasets.setdefault(pid, {})[dname] = Container(did, dname)
+            images = self.images.setdefault(did, [])
+            # a Dataset in several Projects has the same images in each
+            if iid is not None and (did, iid) not in seen:
+                seen.add((did, iid))
+                images.append(IndexedImage(iid, iname, did, dname))
+
+    def get_project(self, name):
+        return self.projects.get(name)
+
+    def get_group_id(self, project):
+        return self.groups[project.id]
+
+    def list_datasets(self, project):
+        """Returns the Datasets of the Project, ordered by name"""
+        return list(self.datasets.get(project.id, {}).values())
+
+    def get_dataset(self, project, name):
+        return self.datasets.get(project.id, {}).get(name)
+
+    def list_images(self, dataset):
+        """Returns the Images of the Dataset, ordered by name"""
+        return list(self.images.get(dataset.id, []))
+
+    def all_images(self):
+        """Returns the Images of all the Datasets in the index"""
+        return [image for images in self.images.values() for image in images]
+
+
+def load_index(conn, project_names=None, container_type="Project", ids=None,
+               cache_path=None, ttl=0):
+    """
+    Loads a ContainerIndex for the Projects named project_names, or for the
+    Projects or Datasets (container_type) with the given ids.
+
+    With cache_path and a ttl in seconds, the rows are saved to a json file
+    and re-used by later runs until the file is older than ttl, if they were
+    loaded with the same arguments.
+    """
+    # the arguments the rows were loaded with, saved with them in the cache
+    query_args = {
+        "project_names": sorted(project_names) if project_names is not None else None,
+        "container_type": container_type,
+        "ids": sorted(ids) if ids is not None else None,
+    }
+    if cache_path and ttl > 0 and os.path.exists(cache_path):
+        if time.time() - os.path.getmtime(cache_path) < ttl:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            # files from before the arguments were saved are a list of rows
+            if isinstance(cached, dict) and cached.get("query") == query_args:
+                return ContainerIndex(cached["rows"])
+            print("Not re-using %s, it was loaded for other containers" % cache_path)
+
+    # all groups, since we don't know the group of the containers yet
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    params = omero.sys.ParametersI()
+    if project_names is not None:
+        params.add("names", omero.rtypes.wrap(list(project_names)))
+        query = QUERY % "p.name in (:names)"
+    elif container_type == "Project":
+        params.addIds(ids)
+        query = QUERY % "p.id in (:ids)"
+    elif container_type == "Dataset":
+        params.addIds(ids)
+        query = DATASET_QUERY
+    else:
+        raise ValueError("Not a Project or Dataset: %s" % container_type)
+    result = conn.getQueryService().projection(query, params, ctx)
+    rows = [[omero.rtypes.unwrap(value) for value in row] for row in result]
+    if query == DATASET_QUERY:
+        rows = [[None, None, None] + row for row in rows]
+
+    if cache_path and ttl > 0:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump({"query": query_args, "rows": rows}, f)
+    return ContainerIndex(rows)
@@ -1,18 +1,31 @@
 #!/usr/bin/env python
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
+import numpy as np
 import pandas
-from collections import defaultdict
-import tempfile
 import os
-import decimal
+import time
+import traceback
 
 import omero.clients
 import omero.cli
 import omero
 from omero.rtypes import rint, rdouble, rstring, unwrap
-from omero_metadata.populate import ParsingContext
+from omero.constants.namespaces import NSBULKANNOTATIONS
+from omero.grid import DoubleColumn, LongColumn, RoiColumn, StringColumn
 from omero.util.metadata_utils import NSBULKANNOTATIONSRAW
 
+from omero_bulk import RoiBatch, ROI_BATCH_SIZE, delete_objects, find_roi_ids
+from checkpoint import CheckpointStore, DEFAULT_WORK_DIR
+from container_index import load_index
+from file_index import FileIndex, report_missing, template_root
+import instrument
+from instrument import span
+from table_cache import TableCache
+
 """
 This script parses data_table.csv files, 1 per embryo to create
 a Point for each row.
@@ -49,20 +62,19 @@ colors = {
 projectB_name = "idr0101-payne-insitugenomeseq/experimentB"
 projectA_name = "idr0101-payne-insitugenomeseq/experimentA"
 
-def get_dataset(B, embryo_id):
-    for dataset in B.listChildren():
-        if dataset.name == "Embryo_%02d" % embryo_id:
-            return dataset
+def get_dataset(index, B, embryo_id):
+    return index.get_dataset(B, "Embryo_%02d" % embryo_id)
 
 
-def get_image(dataset, name_contains):
-    imgs = [image for image in dataset.listChildren() if name_contains in image.name]
+def get_image(index, dataset, name_contains):
+    imgs = [image for image in index.list_images(dataset) if name_contains in image.name]
     assert len(imgs) < 2
     if len(imgs) == 1:
         return imgs[0]
 
 
-def create_roi(updateService, image, shapes):
+def create_roi(image, shapes):
+    """Returns an unsaved ROI on the image, to be saved with a RoiBatch"""
     roi = omero.model.RoiI()
     # Give ROI a name if first shape has one
     name = unwrap(shapes[0].textValue)
@@ -71,17 +83,16 @@ def create_roi(updateService, image, shapes):
     roi.setImage(image._obj)
     for shape in shapes:
         roi.addShape(shape)
-    return updateService.saveAndReturnObject(roi)
+    return roi
 
 
-def delete_rois(conn, im):
-    result = conn.getRoiService().findByImage(im.id, None)
-    to_delete = []
-    for roi in result.rois:
-        to_delete.append(roi.getId().getValue())
+def delete_rois(conn, image_ids):
+    """Deletes the ROIs with Points or Rectangles on all the images"""
+    to_delete = find_roi_ids(conn, image_ids, ["Point", "Rectangle"])
     if to_delete:
         print("Deleting existing {} rois".format(len(to_delete)))
-        conn.deleteObjects("Roi", to_delete, deleteChildren=True, wait=True)
+        delete_objects(conn, "Roi", to_delete)
+        instrument.count("rois_deleted", len(to_delete))
 
 
 def rgba_to_int(red, green, blue, alpha=255):
@@ -111,211 +122,697 @@ tables_path_B = base_path + "20210421-ftp/annotations/embryo/data_tables/embryo%
 bounds_path_B = base_path + "20210127-ftp/annotations/embryo/embryo_bounds/embryo%02d_bounds.txt"
 
 
-def process_bounds(conn, image, image_id, file_path):
+def read_bounds(bounds_pth):
+    """
+    Returns an (N, 6) array of x, y, z, width, height, depth for each cell of
+    a bounds file. Files with 4 columns (no Z) get z -1 and depth 1.
+    """
+    if os.path.getsize(bounds_pth) == 0:
+        return np.empty((0, 6))
+    bounds = np.loadtxt(bounds_pth, delimiter=",", ndmin=2)
+    if bounds.shape[1] == 4:
+        x, y, width, height = bounds.T
+        bounds = np.column_stack([x, y, np.full(len(bounds), -1), width, height,
+                                  np.ones(len(bounds))])
+    elif bounds.shape[1] != 6:
+        raise ValueError("%s has %s columns, not 4 or 6" % (bounds_pth, bounds.shape[1]))
+    return bounds
+
+
+def bounds_planes(bounds, collapse_z=False):
+    """
+    Returns (cells, theZ): the row of bounds and the Z index of each
+    Rectangle, with a Rectangle for each Z of a cell, or one per cell with
+    theZ -1 (not set) if collapse_z
+    """
+    z_start = bounds[:, 2].astype(int)
+    z_end = (bounds[:, 2] + bounds[:, 5]).astype(int)
+    if collapse_z:
+        cells = np.arange(len(bounds))
+        return cells, np.full(len(bounds), -1)
+    counts = np.maximum(z_end - z_start, 0)
+    cells = np.repeat(np.arange(len(bounds)), counts)
+    # offset of each Rectangle in the Z range of its cell
+    offsets = np.arange(len(cells)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return cells, z_start[cells] + offsets
+
+
+def process_bounds(conn, image, image_id, file_path, batch_size=ROI_BATCH_SIZE,
+                   collapse_z=False):
+    """
+    Adds a ROI of Rectangles to the image for each cell in the bounds file,
+    returning the ROI IDs
+
+    :param collapse_z: Add a single Rectangle across all Z for each cell,
+                       with the Z range of the cell in the ROI description,
+                       instead of a Rectangle on each plane
+    """
 
     bounds_pth = file_path % image_id
     print('bounds_pth', bounds_pth)
 
-    updateService = conn.getUpdateService()
-
-    with open(bounds_pth, 'r') as f:
-        for l in f.readlines():
-            if not l:
-                continue
-            coords = [float(n) for n in l.split(",")]
-            if len(coords) == 6:
-                x_start, y_start, z_start, x_length, y_length, z_length = coords
-            else:
-                x_start, y_start, x_length, y_length = coords
-                z_start = -1    # don't set theZ
-                z_length = 1    # single rectangle across all Z
-
-            shapes = []
-            for z in range(int(z_start), int(z_start + z_length)):
-                rect = omero.model.RectangleI()
-                # coords are in pixel units
-                rect.x = rdouble(x_start)
-                rect.y = rdouble(y_start)
-                rect.width = rdouble(x_length)
-                rect.height = rdouble(y_length)
-                if z > -1:
-                    rect.theZ = rint(z)
-                shapes.append(rect)
-
-            roi = create_roi(updateService, image, shapes)
-
-
-def populate_metadata(image, file_path, file_name):
-    """Parses csv to create OMERO.table"""
-    client = image._conn.c
-    ctx = ParsingContext(
-        client, image._obj, file=file_path, allow_nan=True
-    )
-    ctx.parse()
-
-
-def process_image(conn, image, embryo_id, tables_path, cell_id=None):
-
-    if image.getROICount() > 0:
-        return
-
-    updateService = conn.getUpdateService()
-
-    # Read csv for each embryo
-    table_pth = tables_path % embryo_id
-    df = pandas.read_csv(table_pth, delimiter=",")
-
-    col_types = [get_omero_col_type(t) for t in df.dtypes]
-    col_names = list(df.columns)
-
-    # Create output table with extra columns
-    df2 = pandas.DataFrame(columns=(["roi", "shape"] + col_names))
-
-    rows_by_chr = defaultdict(list)
-    max_chr = 0
-  
-
-    # first, group rows by chr_id (or hg38_chr ?? for experimentA)
+    batch = RoiBatch(conn.getUpdateService(), batch_size)
+
+    with span("read_bounds"):
+        bounds = read_bounds(bounds_pth)
+
+    with span("create_shapes"):
+        cells, planes = bounds_planes(bounds, collapse_z)
+        shapes = {}
+        # coords are in pixel units
+        for cell, z, (x, y, width, height) in zip(
+                cells.tolist(), planes.tolist(), bounds[cells][:, [0, 1, 3, 4]].tolist()):
+            rect = omero.model.RectangleI()
+            rect.x = rdouble(x)
+            rect.y = rdouble(y)
+            rect.width = rdouble(width)
+            rect.height = rdouble(height)
+            if z > -1:
+                rect.theZ = rint(z)
+            shapes.setdefault(cell, []).append(rect)
+
+        for cell, cell_shapes in shapes.items():
+            roi = create_roi(image, cell_shapes)
+            z_start, depth = bounds[cell, 2], bounds[cell, 5]
+            if collapse_z and z_start > -1:
+                roi.description = rstring("Z %d-%d" % (z_start, z_start + depth - 1))
+            batch.add(roi)
+        instrument.count("shapes", len(cells))
+
+    rois = batch.flush()
+    print("saved %s rois" % len(rois))
+    instrument.count("rois", len(rois))
+    return [roi.id.val for roi in rois]
+
+
+def round_half_up(values):
+    """
+    Rounds an array to the nearest int, with .5 always rounded away from 0.
+
+    Same as decimal ROUND_HALF_UP (not the Python3 rounding .5 to even number).
+    values - floor(values) is exact for floats so there's no error at .5
+    """
+    magnitude = np.abs(values)
+    rounded = np.floor(magnitude)
+    rounded += (magnitude - rounded) >= 0.5
+    return (np.sign(values) * rounded).astype(np.int64)
+
+
+def get_cell_key(tables_path):
+    """Returns the data_table columns of the cell ID and chr ID"""
+    if 'embryo' in tables_path:
+        return 'cell_id', 'chr'
+    return 'fov_cell', 'hg38_chr'
+
+
+class DataTable(object):
+    """
+    A data_table read once for all the images of a FOV or embryo, with the
+    row positions of each cell from a single groupby.
+    """
+
+    def __init__(self, df, tables_path):
+        self.df = df
+        self.tables_path = tables_path
+        cell_key, chr_key = get_cell_key(tables_path)
+        self.cells = df.groupby(cell_key, sort=False).indices
+
+    def get_rows(self, cell_id=None):
+        """Returns the rows of the cell, in table order, or all the rows"""
+        if cell_id is None:
+            return self.df
+        positions = self.cells.get(cell_id, np.empty(0, dtype=np.intp))
+        return self.df.iloc[positions]
+
+
+class DataTableLoader(object):
+    """
+    Reads the data_table of a task, keeping the last one read so that the
+    tasks of a FOV or embryo (which come together) share it.
+    """
+
+    def __init__(self, tables=None):
+        self.tables = tables
+        self.key = None
+        self.data_table = None
+
+    def get(self, tables_path, embryo_id):
+        if self.key != (tables_path, embryo_id):
+            table_pth = tables_path % embryo_id
+            print("Reading", table_pth)
+            with span("read_table"):
+                if self.tables is None:
+                    df = pandas.read_csv(table_pth, delimiter=",")
+                else:
+                    df = self.tables.read(table_pth)
+                self.data_table = DataTable(df, tables_path)
+            instrument.count("table_rows_read", len(df))
+            self.key = (tables_path, embryo_id)
+        return self.data_table
+
+
+def get_point_columns(rows, tables_path, cell_id=None):
+    """
+    Computes the Point values for rows of a data_table as columns.
+
+    :param rows: The rows of the cell_id, or all rows if cell_id is None
+    Returns a DataFrame with chr_id, x, y, z, text and color columns, indexed
+    by the source rows and sorted by chr_id, keeping the row order
+    within each chr_id.
+    """
     if cell_id is None:
         # experimentB only...
-        for index, row in df.iterrows():
-            # chr_id based on cell AND chr for _hybridization images
-            chr_id = (100 * row['cell_id']) + row['chr']       # e.g. 120
-            max_chr = max(max_chr, chr_id)
-            rows_by_chr[chr_id].append(row)
+        # chr_id based on cell AND chr for _hybridization images
+        chr_ids = (100 * rows['cell_id']) + rows['chr']       # e.g. 120
+    else:
+        cell_key, chr_key = get_cell_key(tables_path)
+        chr_ids = rows[chr_key]
+
+    # corrected coords for experiment B _hyb
+    if cell_id is None and 'embryo' in tables_path:
+        suffix = "_um_abs"
     else:
-        # filter table rows by cell_id
-        if 'embryo' in tables_path:
-            cell_key = 'cell_id'
-            chr_key = 'chr'
-        else:
-            cell_key = 'fov_cell'
-            chr_key = 'hg38_chr'
-        for index, row in df.loc[df[cell_key] == cell_id].iterrows():
-            chr_id = row[chr_key]
-            max_chr = max(max_chr, chr_id)
-            rows_by_chr[chr_id].append(row)
-
-    def get_coord(row, xyz="x"):
-        # corrected coords for experiment B _hyb
-        if cell_id is None and 'embryo' in tables_path:
-            return row[xyz + "_um_abs"]
         # experiment A or processed experiment B images
-        return row[xyz + "_um"]
+        suffix = "_um"
 
-    # Create 1 ROI for each chr (per cell)
-    for chr_id in range(max_chr):
-        if chr_id not in rows_by_chr:
-            continue
-        print(chr_id, "creating ROI with %s points" % (len(rows_by_chr[chr_id])))
-
-        points = []
-        # create a Point for each row
-        for row in rows_by_chr[chr_id]:
-            point = omero.model.PointI()
-            # NB: switch X and Y (analysis used a different coordinate system)
-            point.y = rdouble(get_coord(row, 'x') * 9.2306)
-            point.x = rdouble(get_coord(row, 'y') * 9.2306)
-            # We don't want Python3 behaviour of rounding .5 to even number - always round up
-            point.theZ = rint(int(decimal.Decimal(get_coord(row, 'z') * 2.5).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_UP)))
-            if 'embryo' in tables_path:
-                # experimentB - get chr number from name
-                chr_name = row['chr_name']
-                if cell_id is None:
-                    point.textValue = rstring(f"cell{row['cell_id']}_{row['chr_name']}")
-                else:
-                    point.textValue = rstring(row['chr_name'])
+    if 'embryo' in tables_path:
+        # experimentB - get chr number from name
+        chr_names = rows['chr_name'].astype(str)
+        if cell_id is None:
+            text = "cell" + rows['cell_id'].astype(str) + "_" + chr_names
+        else:
+            text = chr_names
+    else:
+        # experimentA - no cell ID included in chr_id
+        text = 'hg38_chr' + rows['hg38_chr'].astype(str)
+        chr_names = 'chr' + rows['hg38_chr'].astype(str)
+
+    color_ints = {name: rgba_to_int(*rgb) for name, rgb in colors.items()}
+    points = pandas.DataFrame({
+        "chr_id": chr_ids,
+        # NB: switch X and Y (analysis used a different coordinate system)
+        "x": rows["y" + suffix] * 9.2306,
+        "y": rows["x" + suffix] * 9.2306,
+        # We don't want Python3 behaviour of rounding .5 to even number - always round up
+        "z": round_half_up(rows["z" + suffix].to_numpy() * 2.5),
+        "text": text,
+        "color": chr_names.map(color_ints),
+    }, index=rows.index)
+
+    # 1 ROI for each chr_id in range(max_chr), same as the original loop
+    max_chr = max(0, chr_ids.max()) if len(chr_ids) else 0
+    points = points.loc[(points["chr_id"] >= 0) & (points["chr_id"] < max_chr)]
+    order = np.argsort(points["chr_id"].to_numpy(), kind="stable")
+    return points.iloc[order]
+
+
+def group_by_chr(points):
+    """Yields (chr_id, points) for each chr_id of sorted point columns"""
+    chr_ids = points["chr_id"].to_numpy()
+    starts = np.flatnonzero(np.diff(chr_ids, prepend=np.nan) != 0)
+    ends = np.append(starts[1:], len(chr_ids))
+    for start, end in zip(starts, ends):
+        yield chr_ids[start], points.iloc[start:end]
+
+
+def create_points(points):
+    """Creates a PointI for each row of point columns"""
+    shapes = []
+    for x, y, z, text, color in zip(
+            points["x"].tolist(), points["y"].tolist(), points["z"].tolist(),
+            points["text"].tolist(), points["color"].tolist()):
+        point = omero.model.PointI()
+        point.x = rdouble(x)
+        point.y = rdouble(y)
+        point.theZ = rint(z)
+        point.textValue = rstring(text)
+        # color is NaN for chr_name not in colors
+        if not np.isnan(color):
+            point.strokeColor = rint(int(color))
+        shapes.append(point)
+    return shapes
+
+
+# Name of the OMERO.table, as created by omero metadata populate
+TABLE_NAME = "bulk_annotations"
+# Number of rows in each addData() call to the OMERO.table
+TABLE_BATCH_SIZE = 1000
+
+
+class RoiTableWriter(object):
+    """
+    Collects the roi and shape IDs for rows of a data_table, in buffers sized
+    for the whole table, then creates the OMERO.table on the image in one go.
+
+    The table has the same columns as 'omero metadata populate' creates
+    from a csv with a '# header roi,l,...' line: Roi, shape, the data_table
+    columns (typed with get_omero_col_type) and Roi Name.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.rows = np.empty(len(df), dtype=df.index.dtype)
+        self.roi_ids = np.empty(len(df), dtype=np.int64)
+        self.shape_ids = np.empty(len(df), dtype=np.int64)
+        self.roi_names = np.empty(len(df), dtype=object)
+        self.count = 0
+
+    def add(self, rows, roi_id, shape_ids, roi_name=None):
+        """Adds the saved roi_id and shape_ids for the rows (index labels)"""
+        end = self.count + len(rows)
+        self.rows[self.count:end] = rows
+        self.roi_ids[self.count:end] = roi_id
+        self.shape_ids[self.count:end] = shape_ids
+        self.roi_names[self.count:end] = roi_name or ""
+        self.count = end
+
+    def get_columns(self):
+        """Returns a list of (column, values) with a NumPy array of values"""
+        table = self.df.loc[self.rows[:self.count]]
+        columns = [
+            (RoiColumn("Roi", "", []), self.roi_ids[:self.count]),
+            (LongColumn("shape", "", []), self.shape_ids[:self.count]),
+        ]
+        for name, dtype in table.dtypes.items():
+            col_type = get_omero_col_type(dtype)
+            # HDF5 does not allow / in column names
+            col_name = name.replace("/", "\\")
+            if col_type == "l":
+                columns.append((LongColumn(col_name, "", []), table[name].to_numpy()))
+            elif col_type == "d":
+                columns.append((DoubleColumn(col_name, "", []), table[name].to_numpy()))
             else:
-                # experimentA - no cell ID included in chr_id
-                point.textValue = rstring('hg38_chr' + str(row['hg38_chr']))
-                chr_name = 'chr' + str(row['hg38_chr'])
-            if chr_name in colors:
-                point.strokeColor = rint(rgba_to_int(*colors[chr_name]))
+                # missing values are empty strings, as in the csv
+                values = table[name].fillna("").astype(str).to_numpy()
+                columns.append((string_column(col_name, values), values))
+        names = self.roi_names[:self.count]
+        columns.append((string_column("Roi Name", names), names))
+        return columns
+
+    def save(self, image, batch_size=TABLE_BATCH_SIZE):
+        """Creates the OMERO.table and links it to the image"""
+        conn = image._conn
+        group = str(image.getDetails().group.id.val)
+        columns = self.get_columns()
+
+        instrument.count("table_rows", self.count)
+        table = conn.c.sf.sharedResources().newTable(1, TABLE_NAME, {"omero.group": group})
+        try:
+            table.initialize([column for column, values in columns])
+            for start in range(0, self.count, batch_size):
+                for column, values in columns:
+                    column.values = values[start:start + batch_size].tolist()
+                table.addData([column for column, values in columns])
+            file_id = table.getOriginalFile().id.val
+        finally:
+            table.close()
+
+        file_ann = omero.model.FileAnnotationI()
+        file_ann.ns = rstring(NSBULKANNOTATIONS)
+        file_ann.description = rstring(TABLE_NAME)
+        file_ann.file = omero.model.OriginalFileI(file_id, False)
+        link = omero.model.ImageAnnotationLinkI()
+        link.parent = omero.model.ImageI(image.id, False)
+        link.child = file_ann
+        conn.getUpdateService().saveObject(link, {"omero.group": group})
+        return file_id
+
+
+def string_column(name, values):
+    """Returns a StringColumn wide enough for the utf-8 encoded values"""
+    size = max([len(value.encode("utf-8")) for value in values] + [1])
+    return StringColumn(name, "", size, [])
+
+
+def process_image(conn, image, data_table, cell_id=None, batch_size=ROI_BATCH_SIZE):
+    """
+    Adds Points to the image from a DataTable, returning the ROI IDs
+
+    :param cell_id: Add Points for the rows of this cell, or all rows if None
+    """
+
+    if find_roi_ids(conn, [image.id], ["Point"]):
+        return []
+
+    batch = RoiBatch(conn.getUpdateService(), batch_size)
+
+    # Output table with extra roi and shape columns
+    writer = RoiTableWriter(data_table.df)
+
+    # group rows by chr_id (or hg38_chr for experimentA)
+    with span("point_columns"):
+        rows = data_table.get_rows(cell_id)
+        points = get_point_columns(rows, data_table.tables_path, cell_id)
+        points_by_chr = list(group_by_chr(points))
 
-            points.append(point)
+    # Create 1 ROI for each chr (per cell)
+    with span("create_shapes"):
+        for chr_id, points in points_by_chr:
+            print(chr_id, "creating ROI with %s points" % (len(points)))
 
-        roi = create_roi(updateService, image, points)
+            # create a Point for each row
+            batch.add(create_roi(image, create_points(points)))
 
+    # saved ROIs are in the same order as points_by_chr
+    rois = batch.flush()
+    instrument.count("rois", len(rois))
+    for (chr_id, points), roi in zip(points_by_chr, rois):
         # Need to get newly saved shape IDs
         shapes = list(roi.copyShapes())
         print("saved shapes", len(shapes))
-        for row, shape in zip(rows_by_chr[chr_id], shapes):
-            # checks that the order of shapes is same as order of rows
-            assert shape.theZ.val == decimal.Decimal(get_coord(row, 'z') * 2.5).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_UP)
-            row["roi"] = roi.id.val
-            row["shape"] = shape.id.val
-            df2 = df2.append(row)
-
-    if 'embryo' in tables_path:
-        csv_name = "embryo_rois_%02d.csv" % embryo_id
-    else:
-        csv_name = "pgp1f_rois_%02d.csv" % embryo_id
-    csv_path = os.path.join(tempfile.gettempdir(), csv_name)
-    # Add # header roi, shape, other-col-types...
-    with open(csv_path, "w") as csv_out:
-        csv_out.write("# header roi,l," + ",".join(col_types) + "\n")
-
-    df2.to_csv(csv_path, mode="a", index=False)
-
-    # Create OMERO.table from csv
-    populate_metadata(image, csv_path, csv_name)
-
-
-def main(conn):
-
-    projectA = conn.getObject("Project", attributes={"name": projectA_name})
+        # checks that the order of shapes is same as order of rows
+        assert [shape.theZ.val for shape in shapes] == points["z"].tolist()
+        writer.add(points.index, roi.id.val, [shape.id.val for shape in shapes],
+                   unwrap(roi.name))
+    instrument.count("shapes", writer.count)
+
+    # Create OMERO.table with a row for each Point
+    with span("save_table"):
+        writer.save(image)
+    return [roi.id.val for roi in rois]
+
+
+def get_tasks(conn, index, collapse_z=False):
+    """
+    Returns a task for each image to process, in the order to process them.
+
+    Each task is a dict with the image_id, name and the embryo_id (or fov_id)
+    to process the image with. tables_path is set to add Points from the
+    data_table, bounds_path to add Rectangles from the bounds file, with
+    collapse_z set to add one Rectangle per cell instead of one per plane.
+    Datasets and images are looked up in the ContainerIndex.
+    """
+    tasks = []
+
+    projectA = index.get_project(projectA_name)
     print("Project A", projectA.id)
-    conn.SERVICE_OPTS.setOmeroGroup(projectA.getDetails().group.id.val)
+    conn.SERVICE_OPTS.setOmeroGroup(index.get_group_id(projectA))
 
-    for dataset in projectA.listChildren():
-        for image in dataset.listChildren():
+    for dataset in index.list_datasets(projectA):
+        for image in index.list_images(dataset):
             fov_id = int(dataset.name.replace("Fibroblasts_", ""))
-            print('image.name', image.name)
+            task = {"image_id": image.id, "name": image.name, "embryo_id": fov_id,
+                    "tables_path": None, "cell_id": None, "bounds_path": None}
             if "_processed" not in image.name:
-                delete_rois(conn, image)
                 # Add bounds to _seq images as they seem to fit better than _hyb
                 if "_seq" in image.name:
-                    process_bounds(conn, image, fov_id, bounds_path_A)
-                continue
-            # name e.g. 'cell002_processed'
-            cell_id = int(image.name.replace("cell", "").replace("_processed", ""))
-            print("fov", fov_id, "cell", cell_id)
-            delete_rois(conn, image)
-            process_image(conn, image, fov_id, tables_path_A, cell_id)
+                    task["bounds_path"] = bounds_path_A
+            else:
+                # name e.g. 'cell002_processed'
+                task["cell_id"] = int(image.name.replace("cell", "").replace("_processed", ""))
+                task["tables_path"] = tables_path_A
+            tasks.append(task)
 
     # Embryos - Project B...
-    projectB = conn.getObject("Project", attributes={"name": projectB_name})
+    projectB = index.get_project(projectB_name)
     print("Project B", projectB.id)
 
     for embryo_id in range(1, 58):
-        dataset = get_dataset(projectB, embryo_id)
+        dataset = get_dataset(index, projectB, embryo_id)
         # "I've adjusted some of the columns (x_um_abs, y_um_abs) in the embryo data tables such that
         # you can now lay the data points over the hybridization probe images (e.g. embryo01_hyb.ims for embryo 1)"
-        hyb_image = get_image(dataset, name_contains="_hyb")
-        print("Processing hyb_image", hyb_image.id, hyb_image.name)
-        delete_rois(conn, hyb_image)
-        process_image(conn, hyb_image, embryo_id, tables_path_B)
+        hyb_image = get_image(index, dataset, name_contains="_hyb")
         # Add bounds to _hyb images as they seem to fit better than _seq (opposite of experimentA)
-        process_bounds(conn, hyb_image, embryo_id, bounds_path_B)
+        tasks.append({"image_id": hyb_image.id, "name": hyb_image.name, "embryo_id": embryo_id,
+                      "tables_path": tables_path_B, "cell_id": None, "bounds_path": bounds_path_B})
+        if collapse_z:
+            # only set when used, so the checkpoints of earlier runs stay current
+            tasks[-1]["collapse_z"] = True
 
         cell_id = 1
         # process cell001_processed images
         # For each embryo, we don't know how many cells are present
         # Simply start at 1 and keep checking until None found
-        image = get_image(dataset, name_contains="cell%03d_processed" % cell_id)
+        image = get_image(index, dataset, name_contains="cell%03d_processed" % cell_id)
         while image is not None:
-            print("Processing image", image.id, image.name)
-            delete_rois(conn, image)
-            process_image(conn, image, embryo_id, tables_path_B, cell_id)
+            tasks.append({"image_id": image.id, "name": image.name, "embryo_id": embryo_id,
+                          "tables_path": tables_path_B, "cell_id": cell_id, "bounds_path": None})
             cell_id += 1
-            image = get_image(dataset, name_contains="cell%03d_processed" % cell_id)
+            image = get_image(index, dataset, name_contains="cell%03d_processed" % cell_id)
+
+    return tasks
+
+
+def get_task_inputs(task):
+    """Returns the paths of the files that a task reads"""
+    paths = []
+    if task["tables_path"] is not None:
+        paths.append(task["tables_path"] % task["embryo_id"])
+    if task["bounds_path"] is not None:
+        paths.append(task["bounds_path"] % task["embryo_id"])
+    return paths
+
+
+def get_input_files():
+    """Returns a FileIndex of the data_tables and bounds files"""
+    return FileIndex([template_root(path) for path in
+                      [tables_path_A, bounds_path_A, tables_path_B, bounds_path_B]])
+
+
+def process_task(conn, task, loader, batch_size=ROI_BATCH_SIZE):
+    """
+    Adds the ROIs to the image of a task from get_tasks(), once the old
+    ROIs have been deleted by delete_rois(), saving batch_size ROIs per call
+
+    Returns the IDs of the saved ROIs
+    """
+    image = conn.getObject("Image", task["image_id"])
+    print("Processing image", image.id, image.name)
+    roi_ids = []
+    if task["tables_path"] is not None:
+        data_table = loader.get(task["tables_path"], task["embryo_id"])
+        roi_ids += process_image(conn, image, data_table, task["cell_id"], batch_size)
+    if task["bounds_path"] is not None:
+        roi_ids += process_bounds(conn, image, task["embryo_id"], task["bounds_path"],
+                                  batch_size, collapse_z=task.get("collapse_z", False))
+    return roi_ids
+
+
+def run_task(conn, task, loader, profile_path=None, batch_size=ROI_BATCH_SIZE):
+    """
+    Runs process_task(), returning (task, roi_ids, error, seconds, metrics)
+    instead of raising. metrics is the instrument summary of the task.
+
+    :param profile_path: Save a cProfile of the task to this file
+    """
+    start = time.time()
+    roi_ids = []
+    error = None
+    try:
+        if profile_path is None:
+            roi_ids = process_task(conn, task, loader, batch_size)
+        else:
+            with instrument.profile(profile_path):
+                roi_ids = process_task(conn, task, loader, batch_size)
+    except Exception as exc:
+        traceback.print_exc()
+        error = "%s: %s" % (type(exc).__name__, exc)
+    return task, roi_ids, error, time.time() - start, instrument.take()
+
+
+# BlitzGateway of each worker process, joined to the session of main()
+worker_conn = None
+# TableCache of each worker process
+worker_tables = None
+
+
+def init_worker(host, port, session_key, group_id, cache_dir):
+    global worker_conn, worker_tables
+    client = omero.client(host, port)
+    client.joinSession(session_key)
+    worker_conn = instrument.wrap_services(omero.gateway.BlitzGateway(client_obj=client))
+    worker_conn.SERVICE_OPTS.setOmeroGroup(group_id)
+    if cache_dir is not None:
+        worker_tables = TableCache(cache_dir)
+
+
+def run_worker_tasks(tasks, profile_paths, batch_size):
+    """Runs a group of tasks that share a data_table, reading it once"""
+    loader = DataTableLoader(worker_tables)
+    return [run_task(worker_conn, task, loader, profile_paths.get(task["image_id"]), batch_size)
+            for task in tasks]
+
+
+def iter_worker_results(futures):
+    """
+    Yields the run_task() results of each group of tasks, from
+    {future: tasks}, as they finish. If a worker failed for the whole
+    group (e.g. it was killed, or couldn't join the session), each of its
+    tasks is a failure with that error.
+    """
+    for future in as_completed(futures):
+        try:
+            results = future.result()
+        except Exception as exc:
+            traceback.print_exc()
+            error = "%s: %s" % (type(exc).__name__, exc)
+            results = [(task, [], error, 0.0, instrument.Recorder().summary())
+                       for task in futures[future]]
+        for result in results:
+            yield result
+
+
+def group_tasks(tasks):
+    """Returns lists of the tasks using the same data_table, in task order"""
+    groups = {}
+    for task in tasks:
+        if task["tables_path"] is None:
+            key = ("image", task["image_id"])
+        else:
+            key = (task["tables_path"], task["embryo_id"])
+        groups.setdefault(key, []).append(task)
+    return list(groups.values())
+
+
+def write_metrics(f, metrics):
+    """Writes a JSON line to the metrics file, if there is one"""
+    if f is not None:
+        f.write(json.dumps(metrics) + "\n")
+        f.flush()
+
+
+def main(conn, workers=1, work_dir=DEFAULT_WORK_DIR, force=False, index_ttl=0,
+         cache_tables=True, metrics_path=None, profile_image=None, allow_missing=False,
+         collapse_z=False, batch_size=ROI_BATCH_SIZE):
+
+    run_start = time.time()
+    # count and time every call to the server
+    instrument.wrap_services(conn)
+
+    # Index of all Datasets and Images, from one query (or cache file)
+    index = load_index(conn, [projectA_name, projectB_name],
+                       cache_path=os.path.join(work_dir, "container_index.json"),
+                       ttl=index_ttl)
+
+    # list the input dirs once, and stop before deleting anything if files are missing
+    files = get_input_files()
+    missing = []
+    missing_tasks = []
+    all_tasks = []
+    for task in get_tasks(conn, index, collapse_z):
+        task_missing = files.missing(get_task_inputs(task))
+        if task_missing:
+            missing.extend(task_missing)
+            missing_tasks.append(task)
+        else:
+            all_tasks.append(task)
+    # the tasks of a FOV or embryo share its files
+    report_missing(list(dict.fromkeys(missing)), allow_missing)
+
+    # Skip images done before with the same inputs, unless force
+    checkpoints = CheckpointStore(work_dir, "csv_to_points", files)
+    keys = {}
+    for task in all_tasks:
+        params = {k: v for k, v in task.items() if k != "name"}
+        keys[task["image_id"]] = checkpoints.inputs_key(get_task_inputs(task), params)
+    current = set() if force else checkpoints.current_images(conn, keys)
+    tasks = []
+    for task in all_tasks:
+        if task["image_id"] in current:
+            print("Unchanged Image:%s %s" % (task["image_id"], task["name"]))
+            continue
+        tasks.append(task)
+
+    # Masks from seg_images_to_masks.py are kept
+    delete_rois(conn, [task["image_id"] for task in tasks])
+
+    # data_tables are read from local Arrow copies after the first read
+    cache_dir = os.path.join(work_dir, "tables") if cache_tables else None
+
+    profile_paths = {}
+    if profile_image is not None:
+        profile_paths[profile_image] = os.path.join(
+            work_dir, "csv_to_points_image%s.prof" % profile_image)
+
+    # the index, checkpoints and delete_rois() count towards the run only
+    totals = instrument.Recorder()
+    totals.merge(instrument.take())
+
+    if workers > 1:
+        # each worker logs in by joining this session
+        client = conn.c
+        initargs = (client.getProperty("omero.host"), int(client.getProperty("omero.port")),
+                    client.getSessionId(), conn.SERVICE_OPTS.getOmeroGroup(), cache_dir)
+        # spawned, not forked, since this process has a running Ice communicator
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker, initargs=initargs)
+        # each data_table is read by one worker, for all the images using it
+        futures = {pool.submit(run_worker_tasks, group, profile_paths, batch_size): group
+                   for group in group_tasks(tasks)}
+        results = iter_worker_results(futures)
+    else:
+        pool = None
+        tables = TableCache(cache_dir) if cache_dir is not None else None
+        loader = DataTableLoader(tables)
+        results = (run_task(conn, task, loader, profile_paths.get(task["image_id"]), batch_size)
+                   for task in tasks)
+
+    metrics_file = open(metrics_path, "a") if metrics_path else None
+    # images skipped with --allow-missing
+    failed = list(missing_tasks)
+    for task, roi_ids, error, seconds, metrics in results:
+        status = "FAILED" if error else "OK"
+        print("%s Image:%s %s %.1fs" % (status, task["image_id"], task["name"], seconds))
+        if error:
+            print("    ", error)
+            failed.append(task)
+        else:
+            checkpoints.mark_done(task["image_id"], keys[task["image_id"]], roi_ids)
+        totals.merge(metrics)
+        write_metrics(metrics_file, dict(
+            type="image", image_id=task["image_id"], name=task["name"], status=status,
+            seconds=round(seconds, 3), **metrics))
+    if pool is not None:
+        pool.shutdown()
+
+    print("Processed %s images, %s failed, %s missing inputs" % (
+        len(tasks), len(failed) - len(missing_tasks), len(missing_tasks)))
+    for task in failed:
+        print("FAILED Image:%s %s" % (task["image_id"], task["name"]))
+
+    totals.merge(instrument.take())
+    run_metrics = dict(type="run", images=len(tasks), failed=len(failed), workers=workers,
+                       seconds=round(time.time() - run_start, 3), **totals.summary())
+    print(json.dumps(run_metrics))
+    write_metrics(metrics_file, run_metrics)
+    if metrics_file is not None:
+        metrics_file.close()
+    return failed
+
 
 # Usage:
 # cd idr0101-payne-insitugenomeseq
-# python scripts/csv_to_points.py
+# python scripts/csv_to_points.py [--workers N] [--force] [--metrics metrics.jsonl] [--collapse-z]
+
+parser = argparse.ArgumentParser(description="Create Points and Rectangles from idr0101 tables")
+parser.add_argument("--workers", type=int, default=1,
+    help="Number of processes to handle images in parallel")
+parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+    help="Directory for the checkpoints of images already done")
+parser.add_argument("--force", action="store_true", default=False,
+    help="Redo all images, even if unchanged since the last run")
+parser.add_argument("--index-ttl", type=int, default=0,
+    help="Seconds to re-use the Dataset/Image index cached in the work dir")
+parser.add_argument("--no-table-cache", action="store_true", default=False,
+    help="Read the data_table csv files every time, not via Arrow files in the work dir")
+parser.add_argument("--metrics",
+    help="Append the timings and server calls of each image and of the run as JSON lines")
+parser.add_argument("--profile-image", type=int,
+    help="Save a cProfile of this Image ID in the work dir")
+parser.add_argument("--allow-missing", action="store_true", default=False,
+    help="Skip images with missing data_tables or bounds files, instead of stopping")
+parser.add_argument("--batch-size", type=int, default=ROI_BATCH_SIZE,
+    help="Number of ROIs saved in each call to the server (default %s)" % ROI_BATCH_SIZE)
+parser.add_argument("--collapse-z", action="store_true", default=False,
+    help="Add one Rectangle across all Z for each cell of the embryo bounds, not one per plane")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
+        main(conn, workers=args.workers, work_dir=args.work_dir, force=args.force,
+             index_ttl=args.index_ttl, cache_tables=not args.no_table_cache,
+             metrics_path=args.metrics, profile_image=args.profile_image,
+             allow_missing=args.allow_missing, collapse_z=args.collapse_z,
+             batch_size=args.batch_size)
         conn.close()
@@ -1,55 +1,78 @@
 #!/usr/bin/env python
 
+import argparse
 import omero
 import omero.cli
 
+from container_index import load_index
+from omero_bulk import QUERY_CHUNK_SIZE, chunks, delete_objects
+
 """
 This script deletes PlaneInfo from all experimentA images in idr0101.
 In fact, only pgp1_fov*_hyb and _seq images have a single invalid
 timestamp for T=0, making iviewer show NaNs for other T indices.
 """
 
-# projectB_name = "idr0101-payne-insitugenomeseq/experimentB"
+projectB_name = "idr0101-payne-insitugenomeseq/experimentB"
 projectA_name = "idr0101-payne-insitugenomeseq/experimentA"
 
-def delete_timestamps(conn, image):
 
-    params = omero.sys.ParametersI()
-    params.addLong('pid', image.getPixelsId())
+def query_ids(conn, query, ids):
+    """Returns the first column of the query for each chunk of ids"""
+    result = []
+    for chunk in chunks(ids, QUERY_CHUNK_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(chunk)
+        rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+        result.extend(row[0].val for row in rows)
+    return result
+
+
+def find_plane_infos(conn, image_ids):
+    """Returns the IDs of the PlaneInfo for Z=0, C=0 of all the images"""
+    pixels_ids = query_ids(
+        conn, "select p.id from Pixels p where p.image.id in (:ids)", image_ids)
     z = 0
     c = 0
-    query = "from PlaneInfo as Info where"\
-        " Info.theZ=%s and Info.theC=%s and pixels.id=:pid" % (z, c)
-    info_list = conn.getQueryService().findAllByQuery(
-        query, params, conn.SERVICE_OPTS)
+    query = "select Info.id from PlaneInfo as Info where"\
+        " Info.theZ=%s and Info.theC=%s and Info.pixels.id in (:ids)" % (z, c)
+    return query_ids(conn, query, pixels_ids)
 
-    for info in info_list:
-        print('deleting PlaneInfo', info.id.val)
-        conn.getUpdateService().deleteObject(info)
 
+def delete_timestamps(conn, project_name, index, dry_run=False):
+    project = index.get_project(project_name)
+    print("Project", project.id, project_name)
+    conn.SERVICE_OPTS.setOmeroGroup(index.get_group_id(project))
 
-def main(conn):
-    projectA = conn.getObject("Project", attributes={"name": projectA_name})
-    print("Project A", projectA.id)
-    conn.SERVICE_OPTS.setOmeroGroup(projectA.getDetails().group.id.val)
+    image_ids = [image.id for dataset in index.list_datasets(project)
+                 for image in index.list_images(dataset)]
+    info_ids = find_plane_infos(conn, image_ids)
+    print("Found %s PlaneInfo in %s images" % (len(info_ids), len(image_ids)))
+    if info_ids and not dry_run:
+        delete_objects(conn, "PlaneInfo", info_ids)
+        print("Deleted %s PlaneInfo" % len(info_ids))
 
-    for dataset in projectA.listChildren():
-        for image in dataset.listChildren():
-            print('image.name', image.name)
-            delete_timestamps(conn, image)
 
-    # projectB = conn.getObject("Project", attributes={"name": projectB_name})
-    # print("Project B", projectB.id)
-    # for dataset in projectB.listChildren():
-    #     print("Dataset", dataset.name)
-    #     for image in dataset.listChildren():
-    #         delete_timestamps(conn, image)
+def main(conn, experimentB=False, dry_run=False):
+    project_names = [projectA_name]
+    if experimentB:
+        project_names.append(projectB_name)
+    index = load_index(conn, project_names)
+    for project_name in project_names:
+        delete_timestamps(conn, project_name, index, dry_run)
 
 # Usage:
 # cd idr0101-payne-insitugenomeseq
-# python scripts/delete_timestamps.py
+# python scripts/delete_timestamps.py [--experimentB] [--dry-run]
+
+parser = argparse.ArgumentParser(description="Delete PlaneInfo of idr0101 images")
+parser.add_argument("--experimentB", action="store_true", default=False,
+    help="Also delete the PlaneInfo of experimentB images")
+parser.add_argument("--dry-run", action="store_true", default=False,
+    help="Only count the PlaneInfo that would be deleted")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
+        main(conn, experimentB=args.experimentB, dry_run=args.dry_run)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os
+
+"""
+Index of the input files of the idr0101 scripts, listed once before a run.
+
+Each directory under the roots is read once with os.scandir, instead of
+calling os.path.exists for each seg image or table on the NFS mount. The
+scripts then check all of their inputs against the index and report every
+missing file before changing anything on the server. The size and mtime of
+each file are kept too, for the checkpoint digests.
+"""
+
+
+def template_root(template):
+    """Returns the directory above the first %s of a path template"""
+    return os.path.dirname(template.split("%")[0])
+
+
+class FileIndex(object):
+    """The (size, mtime_ns) of each file name in each directory under the roots"""
+
+    def __init__(self, roots):
+        self.roots = sorted(set(os.path.normpath(root) for root in roots))
+        self.dirs = {}
+        for root in self.roots:
+            self._scan(root)
+
+    def _scan(self, root):
+        # names of each directory by real path, so that a directory reached
+        # through several symlinks (or a symlink loop) is read once
+        real_dirs = {}
+        stack = [(root, os.path.realpath(root))]
+        while stack:
+            path, real_path = stack.pop()
+            if path in self.dirs:
+                continue
+            if real_path in real_dirs:
+                # its subdirectories are checked with os.path.exists
+                self.dirs[path] = real_dirs[real_path]
+                continue
+            names = {}
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        # is_dir() and is_file() follow symlinks, like os.path.exists,
+                        # so a broken symlink is neither and counts as missing
+                        if entry.is_dir():
+                            if entry.is_symlink():
+                                stack.append((entry.path, os.path.realpath(entry.path)))
+                            else:
+                                stack.append((entry.path, os.path.join(real_path, entry.name)))
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            names[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self.dirs[path] = real_dirs[real_path] = names
+
+    def is_indexed(self, path):
+        """True if the path is under one of the roots"""
+        return any(path == root or path.startswith(root + os.sep) for root in self.roots)
+
+    def exists(self, path):
+        """Like os.path.exists for files, from the index for paths in the directories read"""
+        path = os.path.normpath(path)
+        directory, name = os.path.split(path)
+        if not self.is_indexed(path) or directory not in self.dirs:
+            return os.path.exists(path)
+        return name in self.dirs[directory]
+
+    def stat(self, path):
+        """
+        Returns the (size, mtime_ns) of a file, following symlinks, or None
+        if it doesn't exist. Paths outside the index are read with os.stat.
+        """
+        path = os.path.normpath(path)
+        directory, name = os.path.split(path)
+        if not self.is_indexed(path) or directory not in self.dirs:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            return stat.st_size, stat.st_mtime_ns
+        return self.dirs[directory].get(name)
+
+    def missing(self, paths):
+        """Returns the paths that don't exist, in order"""
+        return [path for path in paths if not self.exists(path)]
+
+
+def report_missing(missing, allow_missing=False):
+    """
+    Prints the missing input files. Unless allow_missing, raises
+    FileNotFoundError if there are any.
+    """
+    if not missing:
+        return
+    print("%s input files not found:" % len(missing))
+    for path in missing:
+        print("    ", path)
+    if not allow_missing:
+        raise FileNotFoundError("%s input files not found (use --allow-missing to skip them)"
+                                % len(missing))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import csv
+import os
+import re
+
+import numpy as np
+
+"""
+Parsing of the filePaths.tsv files used for bulk import, and of the
+Bio-Formats .pattern files that they list.
+"""
+
+# <01-08> or <1,2,3> in a pattern file
+PATTERN_BLOCK = re.compile(r"<([^>]+)>")
+
+
+def read_file_paths(tsv_path):
+    """Returns (target, path, name) for each row of a filePaths.tsv"""
+    with open(tsv_path) as f:
+        return [tuple(row[:3]) for row in csv.reader(f, delimiter="\t") if row]
+
+
+def parse_target(target):
+    """
+    Returns (project name, dataset name) of a target like
+    Project:name:idr0101-payne-insitugenomeseq/experimentB/Dataset:name:Embryo_01
+    """
+    project, dataset = target.split("/Dataset:name:")
+    return project.replace("Project:name:", "", 1), dataset
+
+
+def expand_block(block):
+    """Returns the values of a pattern block like 01-08 or 1,2,3"""
+    if "," in block:
+        return block.split(",")
+    start, end = block.split("-")
+    return ["%0*d" % (len(start), value) for value in range(int(start), int(end) + 1)]
+
+
+def expand_pattern(pattern_path):
+    """
+    Returns (channel, file path) for the files of a pattern file, where
+    channel is the index of the file's value of the _c<..> block (or 0)
+    """
+    with open(pattern_path) as f:
+        pattern = f.read().strip()
+    directory = os.path.dirname(pattern_path)
+    parts = PATTERN_BLOCK.split(pattern)
+    # parts alternate text and blocks: text, block, text, block, text
+    texts, blocks = parts[0::2], [expand_block(block) for block in parts[1::2]]
+    channel_block = None
+    for i, text in enumerate(texts[:-1]):
+        if re.search(r"(^|[_\W])(c|ch|channel)$", text, re.IGNORECASE):
+            channel_block = i
+
+    files = []
+    for values in np.ndindex(*[len(values) for values in blocks]):
+        name = texts[0] + "".join(
+            blocks[i][v] + texts[i + 1] for i, v in enumerate(values))
+        channel = values[channel_block] if channel_block is not None else 0
+        files.append((channel, os.path.join(directory, name)))
+    return files
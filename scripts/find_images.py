@@ -1,4 +1,5 @@
 import argparse
+import json
 import re
 import os
 import omero.cli
@@ -7,42 +8,142 @@ DESC = '''
 Find images with a specific name.
 '''
 
+# Images fetched from the server in each page of the query
+PAGE_SIZE = 5000
+
+QUERIES = {
+    "Project": (
+        "select i.id, i.name, d.id, d.name from ProjectDatasetLink pdl"
+        " join pdl.child d join d.imageLinks dil join dil.child i"
+        " where pdl.parent.id in (:ids)"),
+    "Dataset": (
+        "select i.id, i.name, d.id, d.name from DatasetImageLink dil"
+        " join dil.parent d join dil.child i"
+        " where d.id in (:ids)"),
+}
+
+# Characters with a special meaning in a regular expression
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+
 parser = argparse.ArgumentParser(description=DESC)
 parser.add_argument("regex", help="Regular expression to match the image name")
-parser.add_argument("container", help="Project:123 or Dataset:123")
+parser.add_argument("container", nargs="+",
+    help="One or more Project:123 or Dataset:123")
 parser.add_argument("-i",  "--ignorecase", action="store_true", default=False,
     help="Match case-insensitive")
 parser.add_argument("-v",  "--invert", action="store_true", default=False,
     help="Find non-matching images")
-args = parser.parse_args()
+parser.add_argument("--format", choices=["text", "tsv", "json"], default="text",
+    help="text: 'name<TAB>Image:ID', tsv: with Dataset columns and a header, "
+         "json: one JSON object per line")
+
+
+def like_pattern(regex, ignorecase=False):
+    """
+    Returns a 'like' pattern for the literal text at the start of the regex,
+    or None if there isn't any. Every name matching the regex matches the
+    pattern, but not the other way round, so matches are checked again.
+    """
+    # with alternatives, the start of the first isn't needed to match
+    if "|" in regex:
+        return None
+    anchored = regex.startswith("^")
+    if anchored:
+        regex = regex[1:]
+    literal = ""
+    for char in regex:
+        if char in REGEX_SPECIAL:
+            # a quantifier makes the char before it optional
+            if char in "*?{" and literal:
+                literal = literal[:-1]
+            break
+        literal += char
+    if not literal:
+        return None
+    if ignorecase:
+        literal = literal.lower()
+    # '_' and '%' in the literal are 'like' wildcards, which only match more
+    return literal + "%" if anchored else "%" + literal + "%"
+
 
+def parse_container(container):
+    con_type, con_id = container.split(':')
+    if con_type not in QUERIES:
+        parser.error("Not a Project or Dataset: %s" % container)
+    return con_type, int(con_id)
 
-def get_images(conn):
-    con_type = args.container.split(':')[0]
-    con_id = int(args.container.split(':')[1])
-    container = conn.getObject(con_type, attributes={'id': con_id})
-    if con_type == 'Project':
-        for dataset in container.listChildren():
-            for image in dataset.listChildren():
-                yield image
-    elif con_type == 'Dataset':
-        for image in container.listChildren():
-            yield image
 
+def get_images(conn, containers, pattern=None, ignorecase=False, page_size=PAGE_SIZE):
+    """
+    Yields (image_id, image_name, dataset_id, dataset_name) for the images
+    in the containers, fetching only the names, a page at a time.
 
-def main(conn):
+    :param pattern: Optional 'like' pattern the image names must match
+    """
+    ids = {}
+    for con_type, con_id in containers:
+        ids.setdefault(con_type, []).append(con_id)
+
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    qs = conn.getQueryService()
+    seen = set()
+    for con_type, con_ids in ids.items():
+        query = QUERIES[con_type]
+        params = omero.sys.ParametersI()
+        params.addIds(con_ids)
+        if pattern is not None:
+            name = "lower(i.name)" if ignorecase else "i.name"
+            query += " and %s like :pattern" % name
+            params.addString("pattern", pattern)
+        query += " order by i.id, d.id"
+
+        offset = 0
+        while True:
+            params.page(offset, page_size)
+            rows = qs.projection(query, params, ctx)
+            for row in rows:
+                image = tuple(omero.rtypes.unwrap(value) for value in row)
+                # Images in a Project and one of its Datasets are only listed once
+                if (image[0], image[2]) not in seen:
+                    seen.add((image[0], image[2]))
+                    yield image
+            if len(rows) < page_size:
+                break
+            offset += page_size
+
+
+def main(conn, args):
     if args.ignorecase:
         exp = re.compile(args.regex, re.IGNORECASE)
     else:
         exp = re.compile(args.regex)
 
-    for img in get_images(conn):
-        if (exp.search(img.name) and not args.invert) or\
-           (not exp.search(img.name) and args.invert):
-            print(f"{img.name}\tImage:{img.id}")
+    pattern = None
+    if not args.invert:
+        pattern = like_pattern(args.regex, args.ignorecase)
+    containers = [parse_container(container) for container in args.container]
+
+    if args.format == "tsv":
+        print("Image ID\tImage Name\tDataset ID\tDataset Name")
+    for image_id, name, dataset_id, dataset_name in get_images(
+            conn, containers, pattern, args.ignorecase):
+        if (exp.search(name) is None) != args.invert:
+            continue
+        if args.format == "tsv":
+            print(f"{image_id}\t{name}\t{dataset_id}\t{dataset_name}")
+        elif args.format == "json":
+            print(json.dumps({"image_id": image_id, "image_name": name,
+                              "dataset_id": dataset_id, "dataset_name": dataset_name}))
+        else:
+            print(f"{name}\tImage:{image_id}")
+
 
+# Usage:
+# python scripts/find_images.py _hyb Project:1 Project:2 --format tsv
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
+        main(conn, args)
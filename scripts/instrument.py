@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import cProfile
+import functools
+import time
+
+"""
+Timing of the stages of the idr0101 scripts, and of each call to the server.
+
+Code marks its stages with 'with span("save_rois"):' and counts things with
+count("shapes", n). wrap_services(conn) makes every call through the
+gateway's services be counted and timed too. take() returns what was
+recorded since the last take(), as a dict that can be written as a JSON line
+and merged into the totals for a run.
+"""
+
+
+class Recorder(object):
+    """Seconds and counts of spans, server calls and counters"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = Counter()
+
+    def add(self, name, seconds, count=1):
+        self.seconds[name] += seconds
+        self.counts[name] += count
+
+    def merge(self, summary):
+        """Adds a summary from take() (e.g. from a worker process)"""
+        for kind in ("spans", "calls"):
+            for name, values in summary[kind].items():
+                self.add("%s:%s" % (kind, name), values["seconds"], values["count"])
+        self.counts.update({"counters:" + name: value
+                            for name, value in summary["counters"].items()})
+
+    def summary(self):
+        result = {"spans": {}, "calls": {}, "counters": {}}
+        for key, count in sorted(self.counts.items()):
+            kind, name = key.split(":", 1)
+            if kind == "counters":
+                result[kind][name] = count
+            else:
+                result[kind][name] = {"count": count,
+                                      "seconds": round(self.seconds[key], 4)}
+        return result
+
+
+# Recorder of the current image (in each process)
+recorder = Recorder()
+
+
+@contextmanager
+def span(name):
+    """Times the block as the named stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add("spans:" + name, time.perf_counter() - start)
+
+
+def count(name, n=1):
+    recorder.counts["counters:" + name] += n
+
+
+def take():
+    """Returns the summary of what was recorded so far, and starts again"""
+    global recorder
+    summary = recorder.summary()
+    recorder = Recorder()
+    return summary
+
+
+class ServiceProxy(object):
+    """
+    Wraps a service so that each method call is timed as a server call.
+    Ice proxies returned by the calls (e.g. a TablePrx) are wrapped too.
+    """
+
+    def __init__(self, service, name):
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._service, attr)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = value(*args, **kwargs)
+            finally:
+                recorder.add("calls:%s.%s" % (self._name, attr),
+                             time.perf_counter() - start)
+            result_type = type(result).__name__
+            if result_type.endswith("Prx"):
+                return ServiceProxy(result, result_type[:-3])
+            return result
+        return timed
+
+
+def wrapped_getter(get_service, name):
+    """Returns a function like conn.getQueryService returning a ServiceProxy"""
+    def getter():
+        return ServiceProxy(get_service(), name)
+    return getter
+
+
+def wrap_services(conn):
+    """
+    Makes every call through the services of the gateway be recorded.
+
+    BlitzGateway methods like getObject() and deleteObjects() use these
+    services, so their calls are recorded as the service calls they make.
+    """
+    conn.getQueryService = wrapped_getter(conn.getQueryService, "QueryService")
+    conn.getUpdateService = wrapped_getter(conn.getUpdateService, "UpdateService")
+    client = conn.c
+    # omero.client gets sf from __getattr__, so it can be replaced
+    client.sf = ServiceProxy(client.sf, "ServiceFactory")
+    # polls the handle of a request (e.g. Delete2) until it is done
+    client.waitOnCmd = ServiceProxy(client, "Client").waitOnCmd
+    return conn
+
+
+@contextmanager
+def profile(path):
+    """Saves a cProfile of the block to path"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("Saved profile to", path)
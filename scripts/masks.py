@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+"""
+NumPy kernels for turning binary seg planes into packed OMERO mask bytes.
+
+These only need NumPy (and scipy for connected components), so they can be
+used (and benchmarked) without OMERO.
+"""
+
+
+def mask_bounds(stack):
+    """
+    Finds the bounding box of the nonzero pixels in each plane of a stack.
+
+    :param stack: 3D array (Z, Y, X) or a single 2D plane (Y, X)
+    :return: Arrays (z, x, y, width, height) for each non-empty plane
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    rows = stack.any(axis=2)
+    cols = stack.any(axis=1)
+    z = np.flatnonzero(rows.any(axis=1))
+    rows = rows[z]
+    cols = cols[z]
+    # first True from each end of the row and column projections
+    y0 = rows.argmax(axis=1)
+    y1 = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    x0 = cols.argmax(axis=1)
+    x1 = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+    return z, x0, y0, x1 - x0, y1 - y0
+
+
+def pack_mask(plane, x, y, width, height):
+    """
+    Returns the packed bits of the plane within a bounding box.
+
+    np.packbits() treats any nonzero value as 1, so bool and integer planes
+    are packed directly, without converting the box to a wider type.
+    """
+    return np.packbits(plane[y:(y + height), x:(x + width)])
+
+
+def pack_masks(stack):
+    """
+    Yields (z, x, y, width, height, bytes) for each non-empty plane of a stack
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    for z, x, y, w, h in zip(*(a.tolist() for a in mask_bounds(stack))):
+        yield z, x, y, w, h, pack_mask(stack[z], x, y, w, h)
+
+
+def component_masks(stack, min_size=1):
+    """
+    Labels the 3D connected components of a binary stack.
+
+    Yields a list of (z, x, y, width, height, bytes) for each component of at
+    least min_size pixels, with masks cropped to the component on each plane.
+    Needs scipy, and the whole stack in memory.
+    """
+    if ndimage is None:
+        raise ImportError("scipy is needed to split masks into components")
+    labels, count = ndimage.label(np.asarray(stack))
+    for label, box in enumerate(ndimage.find_objects(labels), start=1):
+        if box is None:
+            continue
+        component = labels[box] == label
+        if np.count_nonzero(component) < min_size:
+            continue
+        z0, y0, x0 = (s.start for s in box)
+        yield [(z0 + z, x0 + x, y0 + y, w, h, bytes_)
+               for z, x, y, w, h, bytes_ in pack_masks(component)]
+
+
+def identical_runs(masks):
+    """
+    Finds the runs of consecutive planes with identical masks.
+
+    :param masks: List of (z, x, y, width, height, bytes) sorted by z
+    :return: List of (first z, last z) of each run of 2 or more planes
+    """
+    runs = []
+    start = 0
+    for i in range(1, len(masks) + 1):
+        if i < len(masks) and masks[i][0] == masks[i - 1][0] + 1 \
+                and masks[i][1:5] == masks[i - 1][1:5] \
+                and np.array_equal(masks[i][5], masks[i - 1][5]):
+            continue
+        if i - start > 1:
+            runs.append((masks[start][0], masks[i - 1][0]))
+        start = i
+    return runs
+
+
+def rle_runs(width, height, mask_bytes):
+    """
+    Returns (pixels, runs) of a packed mask: the number of pixels in the mask
+    and the number of runs of mask pixels along its rows, i.e. the number of
+    (start, length) pairs that a run-length encoding would need.
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(mask_bytes), dtype=np.uint8),
+                         count=width * height).reshape(height, width)
+    starts = bits[:, 1:] > bits[:, :-1]
+    return int(np.count_nonzero(bits)), int(np.count_nonzero(starts) + np.count_nonzero(bits[:, 0]))
+
+
+def plane_stats(masks):
+    """
+    Returns a dict of statistics for each of (z, x, y, width, height, bytes):
+    the size of the box, the pixels in the mask and the fraction of the box
+    they fill, the runs along the rows and the bytes as packed bits (as
+    stored in OMERO) or as a run-length encoding of int32 pairs.
+    """
+    stats = []
+    for z, x, y, w, h, mask_bytes in masks:
+        pixels, runs = rle_runs(w, h, mask_bytes)
+        stats.append({
+            "z": z, "box": w * h, "pixels": pixels,
+            "fill": round(pixels / (w * h), 4) if w * h else 0,
+            "runs": runs, "packed_bytes": len(mask_bytes), "rle_bytes": runs * 8,
+        })
+    return stats
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import omero
+from omero.model import MaskI
+from omero.rtypes import rstring
+
+from instrument import span
+
+"""
+Helpers shared by the idr0101 scripts for finding, saving and deleting
+OMERO objects in bulk, instead of making a server round trip for each object.
+"""
+
+# Default number of ROIs sent in each saveAndReturnArray call
+ROI_BATCH_SIZE = 100
+# Number of IDs in each 'in (:ids)' query
+QUERY_CHUNK_SIZE = 1000
+# Number of objects in each Delete2 request
+DELETE_CHUNK_SIZE = 500
+# Longest wait for a Delete2 request to finish (loops of 500 ms)
+DELETE_WAIT_LOOPS = 3600
+# Number of objects in each saveAndReturnArray call of save_objects()
+SAVE_CHUNK_SIZE = 500
+# Largest estimated size of the ROIs in each saveAndReturnArray call. The
+# reply has all the saved ROIs, so it's well under Ice.MessageSizeMax (64 MB)
+ROI_BATCH_BYTES = 16 * 1024 * 1024
+# Estimated size of a Shape in a request, apart from the bytes of a Mask
+SHAPE_BYTES = 200
+
+
+def chunks(values, size):
+    """Yields lists of up to size values"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def roi_bytes(roi):
+    """Returns the estimated size of a ROI in a save request, mostly its Mask bytes"""
+    size = 0
+    for shape in roi.copyShapes():
+        size += SHAPE_BYTES
+        # the bytes of a Mask can be a NumPy array, from masks.mask_bytes()
+        if isinstance(shape, MaskI) and shape.getBytes() is not None:
+            size += len(shape.getBytes())
+    return size
+
+
+class RoiBatch(object):
+    """
+    Collects RoiI objects and saves them with saveAndReturnArray.
+
+    ROIs are sent in chunks of up to batch_size ROIs and max_bytes, as
+    estimated by roi_bytes(), so that neither the request nor the reply
+    (which has all the saved ROIs) is over the Ice message size limit.
+
+    If the server rejects a chunk, it is split in half and each half is
+    retried, so that only a single ROI that can't be saved raises the
+    error. Other errors, like a lost connection or a reply over the size
+    limit, are raised at once, since the chunk may have been saved.
+    """
+
+    def __init__(self, updateService, batch_size=ROI_BATCH_SIZE, max_bytes=ROI_BATCH_BYTES):
+        self.updateService = updateService
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rois = []
+
+    def __len__(self):
+        return len(self.rois)
+
+    def add(self, roi):
+        """Adds a ROI to be saved by the next flush()"""
+        self.rois.append((roi, roi_bytes(roi)))
+
+    def chunks(self, rois):
+        """Yields lists of the (roi, size) up to batch_size ROIs and max_bytes"""
+        chunk = []
+        chunk_bytes = 0
+        for roi, size in rois:
+            if chunk and (len(chunk) == self.batch_size or chunk_bytes + size > self.max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(roi)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def flush(self):
+        """Saves the ROIs added so far and returns them in the same order"""
+        rois, self.rois = self.rois, []
+        saved = []
+        with span("save_rois"):
+            for chunk in self.chunks(rois):
+                saved.extend(self._save(chunk))
+        return saved
+
+    def _save(self, rois):
+        try:
+            return list(self.updateService.saveAndReturnArray(rois))
+        except omero.ApiUsageException as exc:
+            if len(rois) == 1:
+                raise
+            print("Saving %s ROIs failed (%s), retrying in halves" % (len(rois), type(exc).__name__))
+            half = len(rois) // 2
+            return self._save(rois[:half]) + self._save(rois[half:])
+
+
+def find_roi_ids(conn, image_ids, shape_types=None):
+    """
+    Returns the IDs of the ROIs on the images, with 1 query per chunk of images
+
+    :param shape_types: Optional list of Shape classes, e.g. ["Mask"], to only
+                        find ROIs that have a Shape of one of these types
+    """
+    if shape_types is None:
+        queries = ["select r.id from Roi r where r.image.id in (:ids)"]
+    else:
+        queries = ["select distinct s.roi.id from %s s where s.roi.image.id in (:ids)"
+                   % shape_type for shape_type in shape_types]
+    roi_ids = set()
+    with span("find_rois"):
+        for chunk in chunks(image_ids, QUERY_CHUNK_SIZE):
+            params = omero.sys.ParametersI()
+            params.addIds(chunk)
+            for query in queries:
+                result = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+                roi_ids.update(row[0].val for row in result)
+    return sorted(roi_ids)
+
+
+def delete_objects(conn, obj_type, obj_ids, chunk_size=DELETE_CHUNK_SIZE):
+    """
+    Deletes objects (and their children) with a Delete2 request per chunk.
+
+    All the requests are submitted before waiting for any of them to finish.
+    """
+    with span("delete"):
+        handles = [conn.deleteObjects(obj_type, chunk, deleteChildren=True, wait=False)
+                   for chunk in chunks(obj_ids, chunk_size)]
+        for handle in handles:
+            callback = conn.c.waitOnCmd(handle, loops=DELETE_WAIT_LOOPS, ms=500,
+                                        failonerror=True, failontimeout=True,
+                                        closehandle=True)
+            callback.close(True)
+
+
+def save_objects(conn, objects, chunk_size=SAVE_CHUNK_SIZE):
+    """Saves objects with a saveAndReturnArray call per chunk, returning them in order"""
+    saved = []
+    with span("save_objects"):
+        for chunk in chunks(objects, chunk_size):
+            saved.extend(conn.getUpdateService().saveAndReturnArray(chunk, conn.SERVICE_OPTS))
+    return saved
+
+
+def find_dataset_image_links(conn, dataset_id):
+    """
+    Returns the DatasetImageLinks of a Dataset, with the Images loaded,
+    from a single query
+    """
+    params = omero.sys.ParametersI()
+    params.addId(dataset_id)
+    return conn.getQueryService().findAllByQuery(
+        "select l from DatasetImageLink l join fetch l.child where l.parent.id = :id",
+        params, conn.SERVICE_OPTS)
+
+
+def split_dataset(conn, project_id, dataset_id, moves, existing=None, dry_run=False):
+    """
+    Moves and renames Images of a Dataset into other Datasets of the Project,
+    e.g. to split the series of a single fileset import into Datasets.
+
+    The Dataset's links are loaded with 1 query, then the new Datasets,
+    their ProjectDatasetLinks, the renamed Images and the moved links are
+    each saved with saveAndReturnArray calls, instead of round trips for
+    each object. The plan is printed first, and nothing is saved if dry_run.
+
+    :param moves: Dict of {dataset name: [(image name, new image name)]}
+    :param existing: Optional dict of {dataset name: ID} of Datasets in the
+                     Project, which are used instead of creating new ones
+    :return: Dict of {dataset name: ID} of the Datasets that Images were
+             moved to (empty if dry_run)
+    """
+    existing = existing or {}
+    links = {link.child.name.val: link for link in find_dataset_image_links(conn, dataset_id)}
+
+    plan = {}
+    for dataset_name, renames in moves.items():
+        for name, new_name in renames:
+            if name not in links:
+                print("Not found in Dataset:%s: %s" % (dataset_id, name))
+                continue
+            plan.setdefault(dataset_name, []).append((links[name], new_name))
+
+    for dataset_name, renames in plan.items():
+        dataset_id_text = existing.get(dataset_name, "new")
+        print("Dataset %s (%s): %s images" % (dataset_name, dataset_id_text, len(renames)))
+        for link, new_name in renames:
+            print("    Image:%s %s -> %s" % (link.child.id.val, link.child.name.val, new_name))
+    if dry_run:
+        return {}
+
+    new_names = [name for name in plan if name not in existing]
+    datasets = []
+    for name in new_names:
+        dataset = omero.model.DatasetI()
+        dataset.name = rstring(name)
+        datasets.append(dataset)
+    dataset_ids = dict(existing)
+    dataset_ids.update((name, dataset.id.val) for name, dataset
+                       in zip(new_names, save_objects(conn, datasets)))
+
+    pd_links = []
+    for name in new_names:
+        pd_link = omero.model.ProjectDatasetLinkI()
+        pd_link.parent = omero.model.ProjectI(project_id, False)
+        pd_link.child = omero.model.DatasetI(dataset_ids[name], False)
+        pd_links.append(pd_link)
+    save_objects(conn, pd_links)
+    print("Created %s Datasets" % len(new_names))
+
+    images = []
+    moved_links = []
+    for dataset_name, renames in plan.items():
+        for link, new_name in renames:
+            image = link.child
+            image.name = rstring(new_name)
+            images.append(image)
+            link.parent = omero.model.DatasetI(dataset_ids[dataset_name], False)
+            link.child = omero.model.ImageI(image.id.val, False)
+            moved_links.append(link)
+    save_objects(conn, images)
+    save_objects(conn, moved_links)
+    print("Renamed and moved %s Images" % len(images))
+    return {name: dataset_ids[name] for name in plan}
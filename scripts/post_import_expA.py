@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
+import argparse
 import omero.clients
 import omero.cli
-from omero.gateway import DatasetWrapper
+
+from container_index import load_index
+from omero_bulk import split_dataset
 
 """
 This script organises images imported into a single Dataset, into
@@ -12,60 +15,49 @@ do with bulk import as the images are all in the same fileset.
 
 project_name = "idr0101-payne-insitugenomeseq/experimentA"
 
+orig_names = [
+    "pgp1f [pgp1f_cycle01.nd2 (series %02d)]",
+    "pgp1f_hyb [pgp1f_hyb.nd2 (series %02d)]",
+]
+new_names = ["pgp1_fov%02d_seq", "pgp1_fov%02d_hyb"]
+
 
-def main(conn):
+def get_moves():
+    """Returns {dataset name: [(image name, new name)]} for series 2 to 25"""
+    moves = {}
+    for image_number in range(2, 26):
+        moves["Fibroblasts_%02d" % image_number] = [
+            (orig_name % image_number, new_name % image_number)
+            for orig_name, new_name in zip(orig_names, new_names)]
+    return moves
 
-    project = conn.getObject("Project", attributes={"name": project_name})
-    print("Project", project.id, project.getDetails().group.id.val)
-    conn.SERVICE_OPTS.setOmeroGroup(project.getDetails().group.id.val)
 
-    dataset01 = list(project.listChildren())[0]
-    print("dataset01", dataset01)
+def main(conn, dry_run=False):
 
-    images_by_name = {}
-    for image in dataset01.listChildren():
-        images_by_name[image.name] = image
+    index = load_index(conn, [project_name])
+    project = index.get_project(project_name)
+    print("Project", project.id, index.get_group_id(project))
+    conn.SERVICE_OPTS.setOmeroGroup(index.get_group_id(project))
 
-    for image_number in range(2, 26):
-        # Create new Dataset
-        dataset = DatasetWrapper(conn, omero.model.DatasetI())
-        dataset.setName("Fibroblasts_%02d" % image_number)
-        dataset.save()
-        print("Dataset", dataset.id)
-        pd_link = omero.model.ProjectDatasetLinkI()
-        pd_link.child = omero.model.DatasetI(dataset.id, False)
-        pd_link.parent = omero.model.ProjectI(project.id, False)
-        pd_link = conn.getUpdateService().saveAndReturnObject(
-            pd_link, conn.SERVICE_OPTS
-        )
-        print("pd_link", pd_link.id.val)
-
-        orig_names = [
-            "pgp1f [pgp1f_cycle01.nd2 (series %02d)]",
-            "pgp1f_hyb [pgp1f_hyb.nd2 (series %02d)]",
-        ]
-        new_names = ["pgp1_fov%02d_seq", "pgp1_fov%02d_hyb"]
-        for orig_name, new_name in zip(orig_names, new_names):
-            # Find the images
-            name = orig_name % image_number
-            rename = new_name % image_number
-            print(name, rename)
-            if name in images_by_name:
-                img = images_by_name[name]
-                img.setName(rename)
-                img.save()
-                print("linking image...", img.id)
-                link = conn.getQueryService().findByQuery(
-                    "select l from DatasetImageLink as l where l.parent.id=%i and l.child.id=%i"
-                    % (dataset01.id, img.id),
-                    None,
-                    conn.SERVICE_OPTS,
-                )
-                link.parent = omero.model.DatasetI(dataset.id, False)
-                conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+    datasets = index.list_datasets(project)
+    dataset01 = datasets[0]
+    print("dataset01", dataset01.id, dataset01.name)
+
+    # Datasets made by an earlier run are re-used
+    existing = {dataset.name: dataset.id for dataset in datasets[1:]}
+    split_dataset(conn, project.id, dataset01.id, get_moves(), existing, dry_run)
+
+
+# Usage:
+# cd idr0101-payne-insitugenomeseq
+# python scripts/post_import_expA.py [--dry-run]
 
+parser = argparse.ArgumentParser(description="Move idr0101 experimentA images into a Dataset per FOV")
+parser.add_argument("--dry-run", action="store_true", default=False,
+    help="Only print the Datasets to create and the Images to rename and move")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
+        main(conn, dry_run=args.dry_run)
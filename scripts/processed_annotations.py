@@ -1,9 +1,12 @@
+import argparse
 
 import pandas
 import omero
 
 import omero.cli
 
+from container_index import load_index
+
 # Duplicate a row - E.g. for Embryo01
 # Replace... e.g.
 
@@ -16,83 +19,110 @@ import omero.cli
 # Channels: Chanlel 1: ch01; Channel 2: ch02; Channel 3: ch03; Channel 4: ch04; Channel 5: CENPA; Channel 6: DAPI; Channel 7: Hybridization probe; Channel 8: Lamin
 # Processed Data File: 20210421-ftp/annotations/embryo/data_tables/embryo01_data_table.csv
 
-# SET "A" or "B"
-EXPERIMENT = "A"
-
-project_name = "idr0101-payne-insitugenomeseq/experiment" + EXPERIMENT
-table_path = "experiment%s/idr0101-experiment%s-annotation.csv" % (EXPERIMENT, EXPERIMENT)
-output_path = "experiment%s/idr0101-experiment%s-annotation2.csv" % (EXPERIMENT, EXPERIMENT)
-
-channel_names = "Channel 1 (Cy5): dibases AT, CG, GC and TA; Channel 2 (FITC): dibases AA, CC, GG and TT; Channel 3 (Cy3): dibases AC, CA, GT and TG; Channel 4 (TxRed): dibases AG, CT, GA and TC; Channel 5: DAPI; Channel 6: Hybridization probe"
-if EXPERIMENT == "B":
-    channel_names = "Channel 1 (Cy5): dibases AT, CG, GC and TA; Channel 2 (TxRed): dibases AC, CA, GT and TG; Channel 3 (Cy3): dibases AA, CC, GG and TT; Channel 4 (FITC) dibases AG, CT, GA and TC; Channel 5: CENP-A; Channel 6: DAPI; Channel 7: Hybridization probe; Channel 8: Lamin-B"
-
-def main(conn):
-    project = conn.getObject("Project", attributes={"name": project_name})
-    print("Project", project.id)
-    conn.SERVICE_OPTS.setOmeroGroup(project.getDetails().group.id.val)
-
-    df2 = None
-    for dataset in project.listChildren():
-        for image in dataset.listChildren():
-            if "_processed" not in image.name:
-                continue
-
-            df = pandas.read_csv(table_path, delimiter=",")
-            col_names = list(df.columns)
-
-            # Create output table with new rows
-            if df2 is None:
-                df2 = pandas.DataFrame(columns=(col_names))
-
-            # Find rows for Dataset
-            rslt_df = df.loc[df['Dataset Name'] == dataset.name]
-            new_row = None
-            for index, row in df.loc[df['Dataset Name'] == dataset.name].iterrows():
-                # Use first matching row
-                if new_row is None:
-                    new_row = row
-
-                    # cell001_processed -> cell001
-                    cell_name = image.name.replace("_processed", "")
-                    # Embryo_01 -> embryo01 or Fibroblasts_01 -> fibroblasts01
-                    embryo_name = dataset.name.replace("_", "").lower()
-
-                    file_path = "/uod/idr/filesets/idr0101-payne-insitugenomeseq/20210421-processed/"
-                    if EXPERIMENT == "A":
-                        # /uod/idr/filesets/idr0101-payne-insitugenomeseq/20210421-processed/pgp1/fov001/cell006/cell006.pattern
-                        file_path += "pgp1/fov0%s/%s/" % (embryo_name.replace("fibroblasts", ""), cell_name)
-                        data_file = "20210127-ftp/annotations/pgp1f/data_tables/fov%02d_data_table.csv" % (int(cell_name.replace("cell", "")))
-                        source_name = dataset.name.replace("Fibroblasts_", "fov")
-                    else:
-                        file_path += "embryo/%s/%s/" % (embryo_name, cell_name)
-                        data_file = "20210421-ftp/annotations/embryo/data_tables/%s_data_table.csv" % embryo_name
-                        source_name = dataset.name.replace("Embryo_", "embryo")
-
-                    new_row["Image Name"] = image.name
-                    new_row["Assay Name"] = "In situ genome sequencing"
-                    new_row["Source Name"] = source_name
-                    new_row["Image File"] = "%s.pattern" % cell_name
-                    new_row["Comment [Image File Path]"] = file_path
-                    new_row["Comment [Image File Type]"] = "processed"
-                    new_row["Channels"] = channel_names
-                    new_row["Processed Data File"] = data_file
-
-                    print("new_row", dataset.name, new_row)
-                    df2 = df2.append(new_row, ignore_index=True)
-
-    df2.to_csv(output_path, mode="a", index=False)
-
-
-# This takes the idr0101-payne-insitugenomeseq/experimentB/idr0101-experimentB-annotation.csv
-# and adds rows for all the processed cells.
+processed_path = "/uod/idr/filesets/idr0101-payne-insitugenomeseq/20210421-processed/"
+
+EXPERIMENTS = {
+    "A": {
+        "project_name": "idr0101-payne-insitugenomeseq/experimentA",
+        "dataset_prefix": "Fibroblasts_",
+        # /uod/idr/filesets/idr0101-payne-insitugenomeseq/20210421-processed/pgp1/fov001/cell006/cell006.pattern
+        "file_path": processed_path + "pgp1/fov0%(id)s/%(cell)s/",
+        "data_file": "20210127-ftp/annotations/pgp1f/data_tables/fov%(id)s_data_table.csv",
+        "source_name": "fov%(id)s",
+        "channel_names": "Channel 1 (Cy5): dibases AT, CG, GC and TA; Channel 2 (FITC): dibases AA, CC, GG and TT; Channel 3 (Cy3): dibases AC, CA, GT and TG; Channel 4 (TxRed): dibases AG, CT, GA and TC; Channel 5: DAPI; Channel 6: Hybridization probe",
+    },
+    "B": {
+        "project_name": "idr0101-payne-insitugenomeseq/experimentB",
+        "dataset_prefix": "Embryo_",
+        "file_path": processed_path + "embryo/embryo%(id)s/%(cell)s/",
+        "data_file": "20210421-ftp/annotations/embryo/data_tables/embryo%(id)s_data_table.csv",
+        "source_name": "embryo%(id)s",
+        "channel_names": "Channel 1 (Cy5): dibases AT, CG, GC and TA; Channel 2 (TxRed): dibases AC, CA, GT and TG; Channel 3 (Cy3): dibases AA, CC, GG and TT; Channel 4 (FITC) dibases AG, CT, GA and TC; Channel 5: CENP-A; Channel 6: DAPI; Channel 7: Hybridization probe; Channel 8: Lamin-B",
+    },
+}
+
+table_path = "experiment%s/idr0101-experiment%s-annotation.csv"
+output_path = "experiment%s/idr0101-experiment%s-annotation2.csv"
+
+
+def get_processed_images(index, project):
+    """Returns a DataFrame of the Dataset Name and Image Name of the processed images"""
+    rows = [(dataset.name, image.name)
+            for dataset in index.list_datasets(project)
+            for image in index.list_images(dataset)
+            if "_processed" in image.name]
+    return pandas.DataFrame(rows, columns=["Dataset Name", "Image Name"])
+
+
+def fill_template(template, ids, cells):
+    """Formats a template with %(id)s and %(cell)s for each (id, cell)"""
+    return [template % {"id": id_, "cell": cell} for id_, cell in zip(ids, cells)]
+
+
+def processed_rows(df, images, experiment):
+    """
+    Returns new annotation rows for the processed images, copying the first
+    row of each Dataset in df, with the columns of df
+    """
+    config = EXPERIMENTS[experiment]
+    first_rows = df.drop_duplicates("Dataset Name").drop(columns=["Image Name"])
+    # images of Datasets without a row in df are left out
+    rows = images.merge(first_rows, on="Dataset Name", how="inner")
+
+    # cell001_processed -> cell001
+    cells = rows["Image Name"].str.replace("_processed", "", regex=False)
+    # Embryo_01 -> 01 or Fibroblasts_01 -> 01
+    ids = rows["Dataset Name"].str.replace(config["dataset_prefix"], "", regex=False)
+
+    rows["Assay Name"] = "In situ genome sequencing"
+    rows["Source Name"] = fill_template(config["source_name"], ids, cells)
+    rows["Image File"] = cells + ".pattern"
+    rows["Comment [Image File Path]"] = fill_template(config["file_path"], ids, cells)
+    rows["Comment [Image File Type]"] = "processed"
+    rows["Channels"] = config["channel_names"]
+    rows["Processed Data File"] = fill_template(config["data_file"], ids, cells)
+    return rows[list(df.columns)]
+
+
+def main(conn, experiments=("A", "B")):
+    # Datasets and Images of all the Projects, from one query
+    index = load_index(conn, [EXPERIMENTS[experiment]["project_name"]
+                              for experiment in experiments])
+
+    for experiment in experiments:
+        project = index.get_project(EXPERIMENTS[experiment]["project_name"])
+        print("Project", project.id)
+
+        df = pandas.read_csv(table_path % (experiment, experiment), delimiter=",")
+        images = get_processed_images(index, project)
+        rows = processed_rows(df, images, experiment)
+
+        path = output_path % (experiment, experiment)
+        rows.to_csv(path, index=False)
+        print("Wrote %s rows for %s processed images to %s" % (len(rows), len(images), path))
+
+
+# This takes the idr0101-payne-insitugenomeseq/experimentA and experimentB
+# idr0101-experimentX-annotation.csv and writes the rows for all the processed
+# cells to idr0101-experimentX-annotation2.csv
 
 # Usage:
 # cd idr0101-payne-insitugenomeseq
-# python scripts/processed_annotations.py
+# python scripts/processed_annotations.py [A] [B]
+
+def experiment_name(value):
+    if value not in EXPERIMENTS:
+        raise argparse.ArgumentTypeError("experiment must be one of %s" % ", ".join(EXPERIMENTS))
+    return value
+
+
+parser = argparse.ArgumentParser(description="Write annotation rows for the idr0101 processed images")
+parser.add_argument("experiments", nargs="*", type=experiment_name,
+    help="Experiments to write the rows for: A and/or B (default both)")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
-        conn.close()
\ No newline at end of file
+        main(conn, args.experiments or sorted(EXPERIMENTS))
+        conn.close()
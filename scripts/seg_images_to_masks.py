@@ -4,9 +4,12 @@
 # https://raw.githubusercontent.com/IDR/idr0052-walther-condensinmap/master/scripts/upload_and_create_rois.py
 # and omero-roi package: https://github.com/ome/omero-rois
 
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
 import os
 import numpy as np
-from PIL import Image, ImageSequence
 import omero
 import omero.cli
 from omero.gateway import BlitzGateway
@@ -18,6 +21,13 @@ from omero.rtypes import (
     rstring,
 )
 
+from omero_bulk import RoiBatch, delete_objects, find_roi_ids
+from checkpoint import CheckpointStore, DEFAULT_WORK_DIR
+from container_index import load_index
+from file_index import FileIndex, report_missing, template_root
+from tiff_planes import iter_planes
+from masks import component_masks, identical_runs, mask_bounds, pack_mask, plane_stats
+
 """
 This script adds seg_* binary images as masks onto *_processed images in OMERO
 for idr0101 experimentA and experimentB
@@ -54,33 +64,39 @@ def mask_from_binary_image(binim, z, text=None):
     """
     Create a mask shape from a binary image (background=0)
 
-    :param numpy.array binim: Binary 2D array, must contain values [0, 1] only
+    :param numpy.array binim: 2D array, nonzero pixels are in the mask
     :param z: Optional Z-index for the mask
     :return: An OMERO mask
     """
 
+    values = pack_plane(binim, z)
+    if values is None:
+        return None
+    z, x0, y0, w, h, mask_bytes = values
+    return create_mask(x0, y0, w, h, mask_bytes, z, text)
+
+
+def pack_plane(binim, z):
+    """
+    Returns (z, x, y, width, height, bytes) of the mask of a binary image,
+    cropped to its bounding box, or None if the image is empty
+    """
     # Find bounding box to minimise size of mask
-    xmask = binim.sum(0).nonzero()[0]
-    ymask = binim.sum(1).nonzero()[0]
-    if any(xmask) and any(ymask):
-        x0 = min(xmask)
-        w = max(xmask) - x0 + 1
-        y0 = min(ymask)
-        h = max(ymask) - y0 + 1
-        submask = binim[y0:(y0 + h), x0:(x0 + w)]
-    else:
+    bounds = mask_bounds(binim)
+    if len(bounds[0]) == 0:
         return None
+    _, x0, y0, w, h = (int(values[0]) for values in bounds)
+    return z, x0, y0, w, h, pack_mask(binim, x0, y0, w, h)
+
 
+def create_mask(x, y, width, height, mask_bytes, z=None, text=None):
+    """Create a mask shape from the packed bytes of its bounding box"""
     mask = MaskI()
-    # BUG in older versions of Numpy:
-    # https://github.com/numpy/numpy/issues/5377
-    # Need to convert to an int array
-    # mask.setBytes(np.packbits(submask))
-    mask.setBytes(np.packbits(np.asarray(submask, dtype=int)))
-    mask.setWidth(rdouble(w))
-    mask.setHeight(rdouble(h))
-    mask.setX(rdouble(x0))
-    mask.setY(rdouble(y0))
+    mask.setBytes(mask_bytes)
+    mask.setWidth(rdouble(width))
+    mask.setHeight(rdouble(height))
+    mask.setX(rdouble(x))
+    mask.setY(rdouble(y))
 
     if z is not None:
         mask.setTheZ(rint(z))
@@ -94,43 +110,165 @@ def mask_from_binary_image(binim, z, text=None):
     return mask
 
 
-def delete_mask_rois(conn, im):
-    result = conn.getRoiService().findByImage(im.id, None)
-    to_delete = []
-    for roi in result.rois:
-        for shape in roi.copyShapes():
-            if isinstance(shape, MaskI):
-                to_delete.append(roi.getId().getValue())
-                break
+def delete_mask_rois(conn, image_ids):
+    """Deletes the ROIs with Masks on all the images"""
+    to_delete = find_roi_ids(conn, image_ids, ["Mask"])
     if to_delete:
         print("Deleting existing {} rois".format(len(to_delete)))
-        conn.deleteObjects("Roi", to_delete, deleteChildren=True, wait=True)
-
-
-def create_roi(seg_path, text):
-    im = Image.open(seg_path)
-    # read each binary tif plane from stack
-    planes = [np.asarray(plane) for plane in ImageSequence.Iterator(im)]
-    roi = omero.model.RoiI()
-    roi.name = rstring(text)
-    mask_count = 0
-    for z, plane in enumerate(planes):
-        mask = mask_from_binary_image(plane, z, text)
-        if mask is not None:
-            mask_count += 1
-            roi.addShape(mask)
-    print("Added", mask_count, "masks to ROI")
-    return roi
-
-
-def main(conn):
-    updateService = conn.getUpdateService()
-    projectA = conn.getObject("Project", attributes={"name": projectA_name})
+        delete_objects(conn, "Roi", to_delete)
+
+
+def decode_seg(seg_path, split=False, min_size=1, collapse_z=False, stats=False):
+    """
+    Reads a binary tif stack and returns (roi_masks, report), where
+    roi_masks is a list with a list of (z, x, y, width, height, bytes) for
+    each ROI.
+
+    There is 1 ROI with a mask for each non-empty plane, read one plane at a
+    time so only one is held in memory. With split, there is a ROI for each
+    3D connected component of at least min_size pixels instead, with masks
+    cropped to the component on each plane.
+
+    With collapse_z, a stack with the same mask on every plane becomes a
+    single mask with z None (on all planes), since a Shape can't have a
+    range of Z. Other runs of identical planes are only in the report, from
+    seg_report(), which has the plane_stats() of each mask if stats.
+
+    Only plain values are returned, so this can run in a worker process.
+    """
+    if split:
+        stack = np.stack([plane != 0 for plane in iter_planes(seg_path)])
+        planes = len(stack)
+        roi_masks = list(component_masks(stack, min_size))
+    else:
+        planes = 0
+        masks = []
+        for z, plane in enumerate(iter_planes(seg_path)):
+            planes += 1
+            values = pack_plane(plane, z)
+            if values is not None:
+                masks.append(values)
+        roi_masks = [masks]
+
+    report = seg_report(seg_path, roi_masks, planes, stats)
+    if collapse_z and not split and report["identical_runs"] == [[0, planes - 1]]:
+        roi_masks = [[(None,) + masks[0][1:]]]
+        report["collapsed"] = True
+    return roi_masks, report
+
+
+def seg_report(seg_path, roi_masks, planes, stats=False):
+    """
+    Returns a dict of the masks of a seg image, with runs of consecutive
+    identical masks in each ROI, and if stats, the plane_stats() of each
+    mask (which unpacks every mask, so isn't done by default)
+    """
+    runs = [[int(z0), int(z1)] for masks in roi_masks for z0, z1 in identical_runs(masks)]
+    report = {
+        "path": seg_path,
+        "planes": planes,
+        "rois": len(roi_masks),
+        "masks": sum(len(masks) for masks in roi_masks),
+        "packed_bytes": sum(len(mask[5]) for masks in roi_masks for mask in masks),
+        "identical_runs": runs,
+        "collapsed": False,
+    }
+    if stats:
+        roi_stats = [plane_stats(masks) for masks in roi_masks]
+        report["rle_bytes"] = sum(stat["rle_bytes"] for roi in roi_stats for stat in roi)
+        report["plane_stats"] = roi_stats
+    return report
+
+
+def create_rois(roi_masks, text):
+    """Creates an unsaved ROI for each list of masks from decode_seg()"""
+    rois = []
+    for masks in roi_masks:
+        roi = omero.model.RoiI()
+        roi.name = rstring(text)
+        for z, x, y, w, h, mask_bytes in masks:
+            roi.addShape(create_mask(x, y, w, h, mask_bytes, z, text))
+        rois.append(roi)
+    return rois
+
+
+def add_masks(image, decoded, batch):
+    """
+    Adds the ROIs of each (seg, roi_masks, report) to the image, from
+    decode_seg(), returning the ROI IDs
+    """
+    for seg, roi_masks, report in decoded:
+        print('seg', seg)
+        if report["collapsed"]:
+            print("Same mask on all %s planes, saved without Z" % report["planes"])
+        elif report["identical_runs"]:
+            print("Identical masks on planes", report["identical_runs"])
+        rois = create_rois(roi_masks, seg)
+        print("Added", len(rois), "ROIs with", sum(len(masks) for masks in roi_masks), "masks")
+        for roi in rois:
+            roi.setImage(omero.model.ImageI(image.id, False))
+            batch.add(roi)
+    rois = batch.flush()
+    print("saved", len(rois), "rois")
+    return [roi.id.val for roi in rois]
+
+
+def iter_decoded(stale, split=(), min_size=1, workers=1, prefetch=2, collapse_z=False,
+                 stats=False):
+    """
+    Yields (image, key, decoded) for each (image, seg_paths, key), in order,
+    where decoded is a list of (seg, roi_masks, report) from decode_seg().
+
+    With workers, the seg images are decoded by a pool of processes while
+    the caller saves the ROIs of earlier images. The seg images of up to
+    prefetch images are decoded ahead, so that at most prefetch + 1 images
+    of masks are held in memory.
+    """
+    if workers < 1:
+        for image, seg_paths, key in stale:
+            yield image, key, [(seg,) + decode_seg(seg_path, seg in split, min_size,
+                                                   collapse_z, stats)
+                               for seg, seg_path in seg_paths]
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for image, seg_paths, key in stale:
+            futures = [(seg, pool.submit(decode_seg, seg_path, seg in split, min_size,
+                                         collapse_z, stats))
+                       for seg, seg_path in seg_paths]
+            pending.append((image, key, futures))
+            if len(pending) > prefetch:
+                yield get_decoded(*pending.popleft())
+        while pending:
+            yield get_decoded(*pending.popleft())
+
+
+def get_decoded(image, key, futures):
+    """Waits for the decode_seg() futures of an image"""
+    return image, key, [(seg,) + future.result() for seg, future in futures]
+
+
+def get_seg_files():
+    """Returns a FileIndex of the seg images of both experiments"""
+    return FileIndex([template_root(path) for path in
+                      [seg_images_path_A, seg_images_path_B, seg_images_path_B2]])
+
+
+def get_seg_images(conn, index, files):
+    """
+    Returns a list of (image, seg_paths) for the processed images, where
+    seg_paths is a list of (seg, seg_path), and a list of seg paths not found
+    in the FileIndex of seg images
+    """
+    seg_images = []
+    not_found = []
+    projectA = index.get_project(projectA_name)
     print("Project A", projectA.id)
-    conn.SERVICE_OPTS.setOmeroGroup(projectA.getDetails().group.id.val)
+    conn.SERVICE_OPTS.setOmeroGroup(index.get_group_id(projectA))
 
-    for dataset in projectA.listChildren():
-        for image in dataset.listChildren():
+    for dataset in index.list_datasets(projectA):
+        for image in index.list_images(dataset):
             print('image.name', image.name)
             if "_processed" not in image.name:
                 continue
@@ -140,22 +278,21 @@ def main(conn):
             # image e.g. cell002_processed
             cell_name = image.name.replace("_processed", "")
             images_path = seg_images_path_A % (fov_id, cell_name)
-            
-            delete_mask_rois(conn, image)
 
+            seg_paths = []
             for seg in ['nucleus']:
                 seg_path = images_path + 'seg_%s.tif' % seg
-                print('seg', seg)
-                roi = create_roi(seg_path, seg)
-                roi.setImage(image._obj)
-                updateService.saveAndReturnObject(roi)
+                if not files.exists(seg_path):
+                    not_found.append(seg_path)
+                    continue
+                seg_paths.append((seg, seg_path))
+            seg_images.append((image, seg_paths))
 
-    projectB = conn.getObject("Project", attributes={"name": projectB_name})
+    projectB = index.get_project(projectB_name)
     print("Project B", projectB.id)
-    not_found = []
-    for dataset in projectB.listChildren():
+    for dataset in index.list_datasets(projectB):
         print("Dataset", dataset.name)
-        for image in dataset.listChildren():
+        for image in index.list_images(dataset):
             if "_processed" not in image.name:
                 continue
 
@@ -166,29 +303,108 @@ def main(conn):
             image_id = image.name.replace("_processed", "")
             images_path = seg_images_path_B % (embryo_id, image_id)
 
-            delete_mask_rois(conn, image)
-
+            seg_paths = []
             for seg in ['nucleus', 'npbs', 'lamin', 'cenpa']:
                 seg_path = images_path + 'seg_%s.tif' % seg
-                if not os.path.exists(seg_path):
+                if not files.exists(seg_path):
                     # check in later upload dir
                     seg_path = (seg_images_path_B2 % (embryo_id, image_id)) + 'seg_%s.tif' % seg
-                    if not os.path.exists(seg_path):
-                        print("not found", seg_path)
+                    if not files.exists(seg_path):
                         not_found.append(seg_path)
                         continue
-                print('seg', seg)
-                roi = create_roi(seg_path, seg)
-                roi.setImage(image._obj)
-                updateService.saveAndReturnObject(roi)
-
-    print("NOT FOUND:", not_found)
+                seg_paths.append((seg, seg_path))
+            seg_images.append((image, seg_paths))
+
+    return seg_images, not_found
+
+
+def main(conn, work_dir=DEFAULT_WORK_DIR, force=False, split=(), min_size=1,
+         index_ttl=0, workers=1, prefetch=2, collapse_z=False, report_path=None,
+         allow_missing=False):
+    # ROIs for each image are saved together
+    batch = RoiBatch(conn.getUpdateService())
+
+    index = load_index(conn, [projectA_name, projectB_name],
+                       cache_path=os.path.join(work_dir, "container_index.json"),
+                       ttl=index_ttl)
+    # list the seg dirs once, and stop before deleting anything if files are missing
+    files = get_seg_files()
+    seg_images, not_found = get_seg_images(conn, index, files)
+    report_missing(not_found, allow_missing)
+    # the digests of the seg images use their size and mtime from the listing
+    checkpoints = CheckpointStore(work_dir, "seg_images_to_masks", files)
+
+    # Skip images done before with the same seg files, unless force
+    keys = {}
+    for image, seg_paths in seg_images:
+        # options are only in the key when set, so that default runs keep the
+        # checkpoints written before the options were added
+        options = {}
+        if split:
+            options["split"] = sorted(split)
+            options["min_size"] = min_size
+        if collapse_z:
+            options["collapse_z"] = True
+        params = [seg_paths, options] if options else seg_paths
+        keys[image.id] = checkpoints.inputs_key([seg_path for seg, seg_path in seg_paths], params)
+    current = set() if force else checkpoints.current_images(conn, keys)
+    stale = []
+    for image, seg_paths in seg_images:
+        if image.id in current:
+            print("Unchanged", image.name)
+            continue
+        stale.append((image, seg_paths, keys[image.id]))
+
+    delete_mask_rois(conn, [image.id for image, seg_paths, key in stale])
+
+    report_file = open(report_path, "a") if report_path else None
+    # seg images are decoded ahead while the ROIs of each image are saved
+    for image, key, decoded in iter_decoded(stale, split, min_size, workers, prefetch,
+                                            collapse_z, stats=report_file is not None):
+        print('Image', image.name)
+        roi_ids = add_masks(image, decoded, batch)
+        checkpoints.mark_done(image.id, key, roi_ids)
+        if report_file is not None:
+            for seg, roi_masks, report in decoded:
+                report_file.write(json.dumps(dict(image_id=image.id, seg=seg, **report)) + "\n")
+    if report_file is not None:
+        report_file.close()
+
+    if not_found:
+        print("NOT FOUND:", not_found)
 
 # Usage:
 # cd idr0101-payne-insitugenomeseq
-# python scripts/seg_images_to_masks.py
+# python scripts/seg_images_to_masks.py [--force] [--split npbs cenpa --min-size 10] [--workers N]
+
+parser = argparse.ArgumentParser(description="Add Masks from seg images to idr0101 processed images")
+parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+    help="Directory for the checkpoints of images already done")
+parser.add_argument("--force", action="store_true", default=False,
+    help="Redo all images, even if unchanged since the last run")
+parser.add_argument("--split", nargs="+", default=[], choices=list(colors),
+    help="Seg types to split into a ROI per 3D connected component (needs scipy)")
+parser.add_argument("--min-size", type=int, default=1,
+    help="Minimum number of pixels of a component with --split")
+parser.add_argument("--index-ttl", type=int, default=0,
+    help="Seconds to re-use the Dataset/Image index cached in the work dir")
+parser.add_argument("--workers", type=int, default=1,
+    help="Number of processes decoding seg images while ROIs are saved (0 for none)")
+parser.add_argument("--prefetch", type=int, default=2,
+    help="Number of images to decode ahead of the one being saved")
+parser.add_argument("--collapse-z", action="store_true", default=False,
+    help="Save a seg image with the same mask on every plane as 1 mask without Z")
+parser.add_argument("--mask-report",
+    help="Append a JSON line for each seg image with runs of identical planes and RLE stats")
+parser.add_argument("--allow-missing", action="store_true", default=False,
+    help="Skip seg images that are not found, instead of stopping before the run")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     with omero.cli.cli_login() as c:
         conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
-        main(conn)
+        main(conn, work_dir=args.work_dir, force=args.force,
+             split=args.split, min_size=args.min_size, index_ttl=args.index_ttl,
+             workers=args.workers, prefetch=args.prefetch,
+             collapse_z=args.collapse_z, report_path=args.mask_report,
+             allow_missing=args.allow_missing)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+"""
+Local read-through cache of the data_table csv files.
+
+The first read of a csv parses it and saves it as an Arrow IPC file in the
+cache dir, keyed by the path, size and mtime of the csv. Later reads memory-map
+the Arrow file instead of parsing the csv on the NFS mount again, and can
+load only some of the columns.
+
+Needs pyarrow. Without it, tables are read from the csv every time.
+"""
+
+
+class TableCache(object):
+    """Reads csv tables through Arrow files in cache_dir"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if pyarrow is None:
+            print("pyarrow not installed: data_tables will not be cached")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, path):
+        """Returns the Arrow file for the current version of the csv"""
+        stat = os.stat(path)
+        name = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "%s-%s-%s.arrow" % (
+            name, stat.st_size, stat.st_mtime_ns))
+
+    def read(self, path, columns=None):
+        """Returns the csv table as a DataFrame, with all or some columns"""
+        if pyarrow is None:
+            return pandas.read_csv(path, delimiter=",", usecols=columns)
+
+        cache_path = self.cache_path(path)
+        if not os.path.exists(cache_path):
+            df = pandas.read_csv(path, delimiter=",")
+            try:
+                self.write(cache_path, df)
+            except pyarrow.ArrowException as exc:
+                # e.g. a column with mixed types
+                print("Not caching %s: %s" % (path, exc))
+                return df if columns is None else df[columns]
+
+        with pyarrow.memory_map(cache_path) as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+    def write(self, cache_path, df):
+        """Saves the DataFrame, replacing older versions of the same csv"""
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        # written to a temp file, so a failed write (or another process
+        # reading the same csv) can't leave a partial cache file
+        tmp_path = "%s.%s.tmp" % (cache_path, os.getpid())
+        try:
+            with pyarrow.OSFile(tmp_path, "wb") as sink:
+                with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        prefix = os.path.basename(cache_path).split("-")[0] + "-"
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith(".arrow") \
+                    and name != os.path.basename(cache_path):
+                os.remove(os.path.join(self.cache_dir, name))
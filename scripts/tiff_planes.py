@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import numpy as np
+from PIL import Image
+
+"""
+Reads multi-page TIFFs one plane at a time.
+
+Uncompressed planes stored as one contiguous block are memory-mapped rather
+than decoded, so only the pages of the file that are used get read.
+Other planes (compressed or 1-bit) are decoded by PIL, one at a time.
+"""
+
+# PIL raw modes that can be memory-mapped, with the NumPy dtype of the pixels
+RAWMODE_DTYPES = {
+    "L": np.dtype("u1"),
+    "I;8": np.dtype("u1"),
+    "I;8S": np.dtype("i1"),
+    "I;16": np.dtype("<u2"),
+    "I;16B": np.dtype(">u2"),
+    "I;16S": np.dtype("<i2"),
+    "I;16BS": np.dtype(">i2"),
+    "I;32": np.dtype("<u4"),
+    "I;32B": np.dtype(">u4"),
+    "I;32S": np.dtype("<i4"),
+    "I;32BS": np.dtype(">i4"),
+    "F;32F": np.dtype("<f4"),
+    "F;32BF": np.dtype(">f4"),
+}
+
+
+def memmap_plane(path, im):
+    """
+    Returns the current plane of the PIL image as a read-only np.memmap,
+    or None if the plane isn't stored as one uncompressed block.
+    """
+    if len(im.tile) != 1:
+        return None
+    decoder, extents, offset, args = im.tile[0]
+    width, height = im.size
+    if decoder != "raw" or tuple(extents) != (0, 0, width, height) or len(args) != 3:
+        return None
+    rawmode, stride, orientation = args
+    dtype = RAWMODE_DTYPES.get(rawmode)
+    if dtype is None or orientation != 1 or stride not in (0, width * dtype.itemsize):
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(height, width))
+
+
+def iter_planes(path):
+    """Yields each plane of a TIFF as a 2D NumPy array"""
+    with Image.open(path) as im:
+        for index in range(getattr(im, "n_frames", 1)):
+            im.seek(index)
+            plane = memmap_plane(path, im)
+            if plane is None:
+                plane = np.asarray(im)
+            yield plane
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+
+import omero
+import omero.cli
+
+from checkpoint import DEFAULT_WORK_DIR
+from container_index import load_index
+from file_paths import expand_pattern, parse_target, read_file_paths
+
+"""
+Checks filePaths.tsv files before a bulk import: every file of each row
+(the files of a .pattern, or the file itself) must exist, resolving any
+symlinks, and the target Project must exist. Rows whose Dataset doesn't
+exist yet (it will be created by the import) or whose image name is
+already in the Dataset are reported as warnings.
+
+Files are checked by a pool of threads, since each stat on the NFS mount
+mostly waits. Projects, Datasets and Images come from the container index,
+which can be cached in the work dir with --index-ttl.
+"""
+
+
+def check_file(path):
+    """Returns None if the path is a non-empty file, or the problem"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        if os.path.islink(path):
+            return "broken symlink to %s" % os.readlink(path)
+        return "not found"
+    except OSError as exc:
+        return str(exc)
+    if not os.path.isfile(path):
+        return "not a file"
+    if stat.st_size == 0:
+        return "empty file"
+    return None
+
+
+def get_row_files(path):
+    """Returns (files, error) for a row: the files of a .pattern, or [path]"""
+    if not path.endswith(".pattern"):
+        return [path], None
+    try:
+        return [file_path for channel, file_path in expand_pattern(path)], None
+    except (OSError, ValueError) as exc:
+        return [], "pattern: %s" % exc
+
+
+def check_rows(rows, threads=32):
+    """
+    Returns a result dict for each (target, path, name), with the number of
+    files and the errors of the path and its files
+    """
+    results = []
+    row_files = []
+    with ThreadPoolExecutor(threads) as pool:
+        # patterns are read in parallel too
+        for (target, path, name), (files, error) in zip(
+                rows, pool.map(get_row_files, [path for target, path, name in rows])):
+            results.append({"target": target, "path": path, "name": name,
+                            "files": len(files), "errors": [error] if error else [],
+                            "warnings": []})
+            row_files.append(files)
+
+        paths = sorted(set(file_path for files in row_files for file_path in files))
+        problems = dict(zip(paths, pool.map(check_file, paths)))
+
+    seen = set()
+    for result, files in zip(results, row_files):
+        result["errors"].extend("%s: %s" % (file_path, problems[file_path])
+                                for file_path in files if problems[file_path])
+        if (result["target"], result["name"]) in seen:
+            result["warnings"].append("Image name repeated in the target: %s" % result["name"])
+        seen.add((result["target"], result["name"]))
+    return results
+
+
+def check_targets(results, index):
+    """Adds the errors and warnings of the target and name of each result"""
+    for result in results:
+        try:
+            project_name, dataset_name = parse_target(result["target"])
+        except ValueError:
+            result["errors"].append("target is not Project:name:../Dataset:name:..")
+            continue
+        project = index.get_project(project_name)
+        if project is None:
+            result["errors"].append("Project not found: %s" % project_name)
+            continue
+        dataset = index.get_dataset(project, dataset_name)
+        if dataset is None:
+            result["warnings"].append("Dataset will be created: %s" % dataset_name)
+        elif any(image.name == result["name"] for image in index.list_images(dataset)):
+            result["warnings"].append("Image already in Dataset: %s" % result["name"])
+
+
+def main(conn, args):
+    rows = [row for tsv_path in args.file_paths for row in read_file_paths(tsv_path)]
+    print("Checking %s rows" % len(rows))
+    results = check_rows(rows, args.threads)
+
+    if conn is not None:
+        project_names = set()
+        for target, path, name in rows:
+            if "/Dataset:name:" in target:
+                project_names.add(parse_target(target)[0])
+        index = load_index(conn, sorted(project_names),
+                           cache_path=os.path.join(args.work_dir, "validate_index.json"),
+                           ttl=args.index_ttl)
+        check_targets(results, index)
+
+    errors = [result for result in results if result["errors"]]
+    for result in results:
+        for message in result["errors"]:
+            print("ERROR %s %s: %s" % (result["target"], result["name"], message))
+        for message in result["warnings"]:
+            print("WARNING %s %s: %s" % (result["target"], result["name"], message))
+    print("%s rows, %s files, %s rows with errors" % (
+        len(results), sum(result["files"] for result in results), len(errors)))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+    return errors
+
+
+# Usage:
+# cd idr0101-payne-insitugenomeseq
+# python scripts/validate_file_paths.py experimentA/idr0101-processed-filePaths.tsv [--offline] [--report report.json]
+
+parser = argparse.ArgumentParser(description="Check the files and targets of filePaths.tsv files before import")
+parser.add_argument("file_paths", nargs="+", help="filePaths.tsv files to check")
+parser.add_argument("--threads", type=int, default=32,
+    help="Number of threads checking files in parallel")
+parser.add_argument("--report", help="Write the results of each row to this JSON file")
+parser.add_argument("--offline", action="store_true", default=False,
+    help="Only check the files, not the targets on the server")
+parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+    help="Directory for the cached Project/Dataset/Image index")
+parser.add_argument("--index-ttl", type=int, default=0,
+    help="Seconds to re-use the Dataset/Image index cached in the work dir")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.offline:
+        errors = main(None, args)
+    else:
+        with omero.cli.cli_login() as c:
+            conn = omero.gateway.BlitzGateway(client_obj=c.get_client())
+            errors = main(conn, args)
+            conn.close()
+    sys.exit(1 if errors else 0)